@@ -1,55 +1,294 @@
-from flask import Flask, render_template, request, url_for, redirect
-import yt_dlp
+from flask import Flask, render_template, request, url_for, redirect, jsonify, abort, Response, stream_with_context, send_file
+import hashlib
+import json
+import mimetypes
+import os
 import re
+import threading
+from collections import OrderedDict
+from urllib.parse import quote, urlparse
+
+import metrics
+from cache import extract_info, canonical_id
+from formats import FormatIndex
+from jobs import JobQueue, stream_events, follow_download, FINISHED, FAILED
+from selection import Selection
 
 app = Flask(__name__)
+# Behind nginx/Apache, hand finished files to the front server (X-Sendfile) instead of Python
+app.config['USE_X_SENDFILE'] = os.environ.get('YTDL_X_SENDFILE') == '1'
+job_queue = JobQueue()
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+VIEW_MAX_AGE = 60  # seconds browsers and proxies may reuse a video or playlist page without asking
+
+YOUTUBE_URLS = {
+    'video': 'https://www.youtube.com/watch?v={}',
+    'playlist': 'https://www.youtube.com/playlist?list={}',
+}
+
+
+class RenderCache:
+    """
+    Rendered pages by ETag, bounded by count and total size. The ETag covers everything the
+    page is rendered from, so an entry never goes stale, it only falls out.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._pages = OrderedDict()  # etag -> bytes
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, etag: str):
+        with self._lock:
+            page = self._pages.get(etag)
+            if page is not None:
+                self._pages.move_to_end(etag)
+            return page
+
+    def put(self, etag: str, page: bytes) -> None:
+        with self._lock:
+            if etag in self._pages:
+                return
+            self._pages[etag] = page
+            self._size += len(page)
+            while len(self._pages) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self._size -= len(evicted)
+
+
+rendered_pages = RenderCache()
 
 def sanitize_filename(name: str) -> str:
     return re.sub(r'[<>:"/\\|?*]', '_', name)
 
 def get_info(url):
     try:
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
+        info = extract_info(url, {'quiet': True})
     except Exception:
-        pass
+        info = None
     return info
 
+def get_page(url, start, limit):
+    """
+    One page of a playlist's flat listing. Only entries start to start + limit are listed,
+    so the time and memory a page takes do not depend on the length of the playlist.
+
+    :param start: 1-based playlist index of the first entry
+    :return: the info dict, and (entries, cursor of the next page or None) for a playlist
+    """
+    # One entry more than asked for tells whether there is a next page
+    options = Selection([(start, start + limit)]).options({'quiet': True, 'extract_flat': 'in_playlist'})
+    info = extract_info(url, options)
+    if info.get('entries') is None:
+        return info, None
+    # yt-dlp leaves unavailable entries out, requested_entries keeps the positions of the others
+    indices = info.get('requested_entries') or range(start, start + len(info['entries']))
+    listed = [(position, entry) for position, entry in zip(indices, info['entries']) if entry]
+    entries = [
+        {'position': position, 'id': entry.get('id'), 'title': entry.get('title') or entry.get('id'),
+         'url': entry.get('webpage_url') or entry.get('url'), 'duration': entry.get('duration')}
+        for position, entry in listed if position < start + limit
+    ]
+    more = any(position >= start + limit for position, _ in listed)
+    return info, (entries, str(start + limit) if more else None)
+
+def resource_url(url):
+    """
+    :return: the cacheable GET view of a video or playlist URL, None for anything else
+    """
+    kind, _, key = canonical_id(url).partition(':')
+    if kind not in YOUTUBE_URLS:
+        return None
+    # A YouTube URL is rebuilt from the ID, another site's URL travels along for extracting it
+    host = urlparse(url if '://' in url else 'https://' + url).netloc.lower()
+    source = url if '.' in host and not host.endswith(('youtube.com', 'youtu.be')) else None
+    return url_for(f"{kind}_view", **{f"{kind}_id": key}, url=source)
+
+def source_url(kind, key):
+    url = request.args.get('url') or YOUTUBE_URLS[kind].format(key)
+    if canonical_id(url) != f"{kind}:{key}":
+        abort(400)
+    return url
+
+_templates_hash = None
+
+def templates_hash():
+    """
+    :return: hash of the source of every template, read once per process
+    """
+    global _templates_hash
+    if _templates_hash is None:
+        digest = hashlib.sha256()
+        for name in sorted(app.jinja_env.list_templates()):
+            source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, name)
+            digest.update(name.encode() + b'\0' + source.encode() + b'\0')
+        _templates_hash = digest.hexdigest()
+    return _templates_hash
+
+def cached_view(template, **context):
+    """
+    Render template, or answer 304 / serve the page rendered before for the same context.
+    The ETag also covers the templates (a page includes base.html), so a deploy that changes
+    them is not answered from what browsers and proxies kept of the old pages.
+    """
+    fingerprint = json.dumps([templates_hash(), template, context], sort_keys=True, default=str).encode()
+    etag = hashlib.sha256(fingerprint).hexdigest()[:32]
+    if request.if_none_match.contains_weak(etag):  # If-None-Match compares weakly
+        metrics.count('ytdl_views_total', result='not_modified')
+        response = Response(status=304)
+    else:
+        page = rendered_pages.get(etag)
+        metrics.count('ytdl_views_total', result='cached' if page is not None else 'rendered')
+        if page is None:
+            page = render_template(template, **context).encode()
+            rendered_pages.put(etag, page)
+        response = Response(page, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = VIEW_MAX_AGE
+    return response
+
+def playlist_context(url, info, page):
+    entries, next_cursor = page
+    return dict(info=entries, url=url, title=info.get('title'), count=info.get('playlist_count'),
+                next_cursor=next_cursor, entries_url=url_for('playlist_entries'))
+
+def video_context(url, info):
+    with metrics.timer('format_selection'):
+        filtered_formats = FormatIndex.from_info(info).select([1080, 720, 480], ext='mp4')
+    formats = [{'format_id': f.format_id, 'resolution': f.resolution} for f in filtered_formats]
+    return dict(info=formats, url=url, title=info.get('title'))
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         url = request.form['url']
-        info = get_info(url)
-        if 'entries' in info:
-            return render_template('playlist.html', info=info['entries'])
-        else:
-            # return render_template('video.html', url=url)
-            return export_formats(url)
-            # return url_for('video', url=url)
+        # Videos and playlists are GET resources, which browsers and proxies can cache
+        location = resource_url(url)
+        if location is not None:
+            return redirect(location, code=303)
+
+        # Anything else is rendered for this request only.
+        # A flat listing of the first page only, further pages come from playlist_entries
+        try:
+            info, page = get_page(url, 1, PAGE_SIZE)
+        except Exception:
+            info, page = None, None
+        if info is None:
+            return render_template('index.html', error=f"Could not extract {url}"), 400
+        if page is not None:
+            return render_template('playlist.html', **playlist_context(url, info, page))
+        return export_formats(url, info)
 
     return render_template('index.html')
 
-@app.route('/downloading', methods=['GET', 'POST'])
-def download(url, f_id):
-    # format_idx = request.form['format_idx']
-    # url = request.form['url']
-    ydl_opts = {
-        'format': f_id + "+bestaudio",
-        'quiet': False,
-        'merge_output_format': 'mp4',
+@app.route('/videos/<video_id>')
+def video_view(video_id):
+    url = source_url('video', video_id)
+    info = get_info(url)
+    if info is None:
+        return render_template('index.html', error=f"Could not extract {url}"), 502
+    return cached_view('video.html', **video_context(url, info))
+
+@app.route('/playlists/<playlist_id>')
+def playlist_view(playlist_id):
+    url = source_url('playlist', playlist_id)
+    try:
+        info, page = get_page(url, 1, PAGE_SIZE)
+    except Exception:
+        return render_template('index.html', error=f"Could not extract {url}"), 502
+    if page is None:
+        abort(404)
+    return cached_view('playlist.html', **playlist_context(url, info, page))
+
+@app.route('/playlist/entries')
+def playlist_entries():
+    """
+    ?url=<playlist>&cursor=<next_cursor of the previous page>&limit=<entries>, the first page without a cursor.
+    """
+    url = request.args.get('url')
+    cursor = request.args.get('cursor', '1')
+    limit = request.args.get('limit', str(PAGE_SIZE))
+    if not url or not cursor.isdigit() or not limit.isdigit():
+        return jsonify(error="url is required, cursor and limit must be numbers"), 400
+    try:
+        info, page = get_page(url, max(1, int(cursor)), min(max(1, int(limit)), MAX_PAGE_SIZE))
+    except Exception as e:
+        return jsonify(error=str(e)), 502
+    if page is None:
+        return jsonify(error="not a playlist"), 400
+    entries, next_cursor = page
+    return jsonify(entries=entries, next_cursor=next_cursor)
+
+@app.route('/downloading', methods=['POST'])
+def download():
+    url = request.form.get('url')
+    f_id = request.form.get('f_id')
+    if not url or not f_id:
+        return jsonify(error="url and f_id are required"), 400
+
+    # Only enqueue here, the transfer runs on the job queue's workers
+    job = job_queue.submit(url, f_id)
+    links = {
+        'job_id': job.id,
+        'status_url': url_for('job_status', job_id=job.id),
+        'events_url': url_for('job_events', job_id=job.id),
+        'file_url': url_for('job_file', job_id=job.id),
     }
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(links), 202
+    return render_template('job.html', job=job, **links), 202
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
 
-def export_formats(url: str):
-    info = get_info(url)
-    filtered_formats = []
-    for i in range(len(info["formats"])):
-        if 'ext' in info["formats"][i].keys() and info["formats"][i].get('ext') == 'mp4':
-            if info["formats"][i].get('height') in [1080, 720, 480]:
-                filtered_formats.append(info["formats"][i])
-    return render_template('video.html', info=filtered_formats, url=url, title=info.get('title'))
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return Response(stream_with_context(stream_events(job)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/file')
+def job_file(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+
+    if job.status == FINISHED and job.filepath and os.path.exists(job.filepath):
+        # conditional=True answers Range/If-Range and If-None-Match/If-Modified-Since,
+        # the file goes out through wsgi.file_wrapper, which servers like gunicorn turn into sendfile
+        return send_file(job.filepath, as_attachment=True, conditional=True, etag=True, max_age=3600)
+
+    if job.streamable and not job.done():
+        # Still being written: follow the growing file, no Range support until it is complete
+        name = os.path.basename(job.part_file or '').rsplit('.part', 1)[0] or job.title or job.id
+        return Response(stream_with_context(follow_download(job)),
+                        mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(name)}",
+                                 'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+    if job.status == FAILED:
+        return jsonify(job.to_dict()), 409
+    return jsonify(job.to_dict()), 202, {'Retry-After': '5'}
+
+def export_formats(url: str, info=None):
+    if info is None:
+        info = get_info(url)
+    return render_template('video.html', **video_context(url, info))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.prometheus_text(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+"""
+Local archive of a mirrored playlist, for incremental syncs.
+
+A small SQLite file in the playlist's directory keeps one row per video ID:
+its position in the playlist, title, format and the file it was saved to.
+A sync lists the playlist flat (one request), diffs that listing against the
+archive and only touches what changed:
+
+    new      in the playlist, not archived yet (or its file is gone): download
+    changed  archived in another format than the one asked for: download again
+    moved    same video at another position or under another title: rename the file
+    removed  archived, no longer in the playlist: reported, the file is kept
+
+Everything else costs nothing, not even a format check.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from cache import canonical_id
+
+ARCHIVE_NAME = '.ytdl_archive.sqlite3'
+
+
+def video_key(video: Dict) -> str:
+    """
+    :param video: flat playlist entry or journaled video, with 'id' or at least 'url'
+    """
+    if video.get('id'):
+        return video['id']
+    kind, _, value = canonical_id(video['url']).partition(':')
+    return value if kind == 'video' else video['url']
+
+
+class SyncPlan:
+    __slots__ = ('new', 'changed', 'moved', 'unchanged', 'removed')
+
+    def __init__(self):
+        self.new = []        # (position, entry)
+        self.changed = []    # (position, entry)
+        self.moved = []      # (position, entry, archived row)
+        self.unchanged = []  # (position, entry)
+        self.removed = []    # archived rows
+
+    def downloads(self) -> List[Tuple[int, Dict]]:
+        return sorted(self.new + self.changed, key=lambda item: item[0])
+
+    def describe(self) -> str:
+        return (f"{len(self.new)} new, {len(self.changed)} changed, {len(self.moved)} moved, "
+                f"{len(self.unchanged)} unchanged, {len(self.removed)} removed")
+
+
+class Archive:
+    def __init__(self, save_dir: str, name: str = ARCHIVE_NAME):
+        """
+        :param save_dir: directory of the mirrored playlist, the archive lives there too
+        """
+        self.save_dir = save_dir
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(save_dir, name), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            "video_id TEXT PRIMARY KEY, position INTEGER NOT NULL, title TEXT, format_id TEXT, "
+            "filepath TEXT, synced REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS videos_position ON videos (position)")
+        self._db.commit()
+
+    def rows(self) -> Dict[str, Dict]:
+        """
+        :return: video ID -> archived row
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT video_id, position, title, format_id, filepath FROM videos"
+            ).fetchall()
+        return {row[0]: dict(zip(('video_id', 'position', 'title', 'format_id', 'filepath'), row)) for row in rows}
+
+    def diff(self, entries: List[Dict], format_id: Optional[str] = None) -> SyncPlan:
+        """
+        :param entries: the playlist's current flat listing, in playlist order
+        :param format_id: format the mirror should be in, None keeps every video in its archived format
+        """
+        archived = self.rows()
+        plan = SyncPlan()
+        seen = set()
+        for position, entry in enumerate(entries, start=1):
+            if not entry:
+                continue
+            key = video_key(entry)
+            if key in seen:  # A video listed twice is mirrored once, at its first position
+                continue
+            seen.add(key)
+            row = archived.get(key)
+            if row is None or not row['filepath'] or not os.path.exists(row['filepath']):
+                plan.new.append((position, entry))
+            elif format_id and row['format_id'] != format_id:
+                plan.changed.append((position, entry))
+            elif row['position'] != position or (entry.get('title') and row['title'] != entry['title']):
+                plan.moved.append((position, entry, row))
+            else:
+                plan.unchanged.append((position, entry))
+        plan.removed = [row for key, row in archived.items() if key not in seen]
+        return plan
+
+    def preferred_format(self) -> Optional[str]:
+        """
+        :return: the format most of the archived videos are in
+        """
+        with self._lock:
+            formats = [row[0] for row in self._db.execute("SELECT format_id FROM videos WHERE format_id IS NOT NULL")]
+        return Counter(formats).most_common(1)[0][0] if formats else None
+
+    def record(self, video_id: str, position: int, title: Optional[str], format_id: Optional[str],
+               filepath: Optional[str]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO videos (video_id, position, title, format_id, filepath, synced) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (video_id, position, title, format_id, filepath, time.time())
+            )
+            self._db.commit()
+
+    def move(self, moves: List[Tuple[str, int, Optional[str], str]]) -> None:
+        """
+        Rename archived files for their new positions and titles.
+
+        :param moves: (video ID, position, title, new file path)
+        """
+        archived = self.rows()
+        # Through temporary names first, two videos that swapped places would overwrite each other otherwise
+        staged = []
+        for video_id, position, title, filepath in moves:
+            old = archived[video_id]['filepath']
+            os.replace(old, old + '.sync')
+            staged.append((video_id, position, title, old + '.sync', filepath))
+        for video_id, position, title, tmp, filepath in staged:
+            os.replace(tmp, filepath)
+            self.record(video_id, position, title, archived[video_id]['format_id'], filepath)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
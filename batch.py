@@ -0,0 +1,271 @@
+"""
+Non-interactive batch downloads, for cron jobs and bulk archiving.
+
+Reads one job per line from a file or stdin:
+
+    URL [SELECTION [FORMAT]]
+
+SELECTION picks playlist entries ("1,3-7", "-" for all of them) and FORMAT is
+a format ID ("136"), a height ("720p") or "best" (the default, see --format).
+Videos without the chosen format fall back to their closest one. Blank lines
+and lines starting with # are skipped.
+
+Lines run on a bounded pool that only extracts them and picks their formats;
+their downloads are queued on one shared DownloadScheduler, so --workers
+downloads run at once whatever --jobs is.
+Every video gets one JSON line on stdout (or --output), everything else goes
+to stderr:
+
+    {"url": ..., "video": ..., "number": 1, "title": ..., "format_id": "136", "status": "done", "filepath": ...}
+
+    python batch.py urls.txt --out-dir /srv/archive --jobs 4 >> results.jsonl
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, TextIO
+from urllib.parse import urlparse
+
+import metrics
+from cache import extract_info
+from download import start_download
+from formats import FormatIndex, CoverageMatrix, OFFERED_HEIGHTS
+from scheduler import DownloadScheduler, DOWNLOAD_WORKERS, PER_HOST_LIMIT, entry_url, hydrate_videos
+from selection import Selection
+
+JOB_WORKERS = int(os.environ.get('YTDL_BATCH_JOBS', 4))
+
+
+def sanitize_filename(name: str) -> str:
+    return re.sub(r'[<>:"/\\|?*]', '_', name)
+
+
+class BatchLine:
+    __slots__ = ('url', 'selection', 'policy')
+
+    def __init__(self, url: str, selection: Optional[Selection], policy: str):
+        self.url = url
+        self.selection = selection
+        self.policy = policy
+
+    @classmethod
+    def parse(cls, text: str, default_policy: str = 'best') -> Optional['BatchLine']:
+        """
+        :return: None for blank and comment lines
+        :raises ValueError: on a malformed line
+        """
+        text = text.strip()
+        if not text or text.startswith('#'):
+            return None
+        parts = text.split()
+        if len(parts) > 3:
+            raise ValueError("expected URL [SELECTION [FORMAT]]")
+        selection = Selection.parse(parts[1]) if len(parts) > 1 and parts[1] != '-' else None
+        return cls(parts[0], selection, parts[2] if len(parts) > 2 else default_policy)
+
+
+def choose_format(matrix: CoverageMatrix, policy: str) -> Optional[str]:
+    """
+    :param policy: "best", a height such as "720p" or a format ID
+    :return: the format to ask every video for, None if nothing matches
+    """
+    if policy == 'best':
+        return matrix.suggest(OFFERED_HEIGHTS, ext='mp4') or matrix.suggest(OFFERED_HEIGHTS)
+    if policy.endswith('p') and policy[:-1].isdigit():
+        wanted = int(policy[:-1])
+        heights = [height for height in matrix.by_height if height]
+        if not heights:
+            return None
+        # The exact height if any video has it, otherwise the nearest one, lower before higher
+        height = min(heights, key=lambda h: (abs(h - wanted), h > wanted))
+        return matrix.suggest([height], ext='mp4') or matrix.suggest([height])
+    return policy
+
+
+class Batch:
+    def __init__(self, out_dir: str, results: TextIO, jobs: int = JOB_WORKERS,
+                 workers: int = DOWNLOAD_WORKERS, per_host: int = PER_HOST_LIMIT, default_policy: str = 'best'):
+        """
+        :param out_dir: playlists get a directory of their own inside it, single videos go straight in
+        :param results: where the JSON lines are written
+        :param jobs: input lines processed at once
+        :param workers: downloads running at once, across all lines
+        """
+        self.out_dir = out_dir
+        self.results = results
+        self.jobs = max(1, jobs)
+        self.default_policy = default_policy
+        self.scheduler = DownloadScheduler(max_workers=workers, per_host=per_host, collect=False)
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._unwritten = 0  # queued videos whose result line is not written yet
+        self._written = threading.Condition()
+
+    def emit(self, **record) -> None:
+        with self._lock:
+            if record['status'] == 'failed':
+                self.failed += 1
+            self.results.write(json.dumps(record) + '\n')
+            self.results.flush()
+
+    def run(self, lines: Iterable[str]) -> int:
+        """
+        :param lines: consumed lazily, only a window of 2 * jobs lines is extracted at once, and the
+            scheduler holds back queueing while its workers are busy
+        :return: number of failed lines and videos
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='batch') as executor:
+            window = deque()
+            for text in lines:
+                window.append(executor.submit(self.run_line, text))
+                if len(window) >= 2 * self.jobs:
+                    window.popleft().result()
+            for future in window:
+                future.result()
+        with self._written:
+            self._written.wait_for(lambda: not self._unwritten)
+        self.scheduler.shutdown()
+        return self.failed
+
+    def run_line(self, text: str) -> None:
+        """
+        Returns once the line's downloads are queued, their result lines are written as they finish.
+        """
+        try:
+            line = BatchLine.parse(text, self.default_policy)
+        except ValueError as e:
+            self.emit(url=text.strip(), status='failed', error=f"Invalid line: {e}")
+            return
+        if line is None:
+            return
+
+        try:
+            self.submit(line)
+        except Exception as e:
+            self.emit(url=line.url, status='failed', error=str(e))
+
+    def submit(self, line: BatchLine) -> None:
+        """
+        Extract one line's URL, pick its formats and queue its downloads.
+        """
+        options = {'quiet': True, 'extract_flat': 'in_playlist'}
+        if line.selection:
+            options = line.selection.options(options)
+        info = extract_info(line.url, options)
+
+        playlist = info.get('entries') is not None
+        if playlist:
+            indices = info.get('requested_entries') or range(1, len(info['entries']) + 1)
+            entries = [(i, entry) for i, entry in zip(indices, info['entries'])
+                       if entry and (not line.selection or i in line.selection)]
+            hydrated = hydrate_videos(entries, on_error=lambda i, e: self.emit(
+                url=line.url, number=i, status='failed', error=str(e)))
+            save_dir = os.path.join(self.out_dir, sanitize_filename(info.get('title') or info['id']))
+        else:
+            hydrated = [(1, info)]
+            save_dir = self.out_dir
+
+        videos = {}
+        indexes = {}
+        for number, video in hydrated:
+            videos[number] = (entry_url(video), video.get('title') or video.get('id'))
+            indexes[number] = FormatIndex.from_info(video)
+        if not videos:
+            return
+
+        matrix = CoverageMatrix(indexes)
+        format_id = choose_format(matrix, line.policy)
+        chosen_formats = matrix.resolve(format_id) if format_id else dict.fromkeys(indexes)
+
+        for number, chosen in chosen_formats.items():
+            video_url, title = videos[number]
+            record = {'url': line.url, 'video': video_url, 'number': number, 'title': title, 'format_id': chosen}
+            if chosen is None:
+                self.emit(**record, status='skipped', error=f"no format matches {line.policy}")
+                continue
+            name = f"{number:02d}_{sanitize_filename(title)}" if playlist else sanitize_filename(title)
+            ydl_opts = {
+                'format': chosen + "+bestaudio",
+                'quiet': True,
+                'noprogress': True,
+                'merge_output_format': 'mp4',
+                'outtmpl': os.path.join(save_dir, f"{name}.%(ext)s"),
+            }
+            host = indexes[number].get(chosen).host or urlparse(video_url).netloc
+            job = self.scheduler.submit(number, host, self.download, record['video'], ydl_opts)
+            self.report(record, job)
+
+    @staticmethod
+    def download(video_url: str, ydl_opts: Dict) -> Future:
+        """
+        :return: Future of the processed info dict. A download that fails right away raises or
+            returns a failed Future, which the scheduler retries if the error is transient.
+        """
+        return start_download(extract_info(video_url, {'quiet': True}), ydl_opts)
+
+    def report(self, record: Dict, job: Future) -> None:
+        """
+        Write the video's result line once the scheduler is done with it, retries included.
+
+        :param job: the scheduler's Future of download()
+        """
+        def finished(future):
+            try:
+                downloads = future.result().get('requested_downloads') or [{}]
+            except Exception as e:
+                self.emit(**record, status='failed', error=str(e))
+            else:
+                self.emit(**record, status='done', filepath=downloads[0].get('filepath'))
+            with self._written:
+                self._unwritten -= 1
+                self._written.notify_all()
+
+        def started(future):
+            if future.exception() is not None:
+                finished(future)
+            else:
+                future.result().add_done_callback(finished)  # the merge may still be running
+
+        with self._written:
+            self._unwritten += 1
+        job.add_done_callback(started)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default='-', help="file with one job per line, - for stdin")
+    parser.add_argument('--out-dir', default=os.getcwd(), help="where downloads are written")
+    parser.add_argument('--format', default='best', help="format policy of lines that do not give one")
+    parser.add_argument('--jobs', type=int, default=JOB_WORKERS, help="input lines processed at once")
+    parser.add_argument('--workers', type=int, default=DOWNLOAD_WORKERS, help="downloads running at once")
+    parser.add_argument('--per-host', type=int, default=PER_HOST_LIMIT, help="downloads at once per media host")
+    parser.add_argument('--output', help="append the JSON lines to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    stdout = sys.stdout
+    results = open(args.output, 'a', encoding='utf-8') if args.output else stdout
+    # Progress and messages go to stderr, stdout only carries results
+    sys.stdout = sys.stderr
+    lines = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    try:
+        batch = Batch(args.out_dir, results, jobs=args.jobs, workers=args.workers,
+                      per_host=args.per_host, default_policy=args.format)
+        failed = batch.run(lines)
+    finally:
+        sys.stdout = stdout
+        if lines is not sys.stdin:
+            lines.close()
+        if results is not stdout:
+            results.close()
+    print(metrics.summary(), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
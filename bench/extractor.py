@@ -0,0 +1,62 @@
+"""
+yt-dlp extractors for the local bench server.
+
+The bench server speaks YouTube-shaped URLs (/watch?v=..., /playlist?list=...)
+so the scripts' URL handling and caching run unchanged. register() puts these
+extractors in front of yt-dlp's own, and EXTRACTIONS counts the calls.
+"""
+
+import threading
+
+from yt_dlp.extractor.common import InfoExtractor
+
+_BASE = r'(?P<base>https?://(?:127\.0\.0\.1|localhost):\d+)'
+
+EXTRACTIONS = {'video': 0, 'playlist': 0}
+_lock = threading.Lock()
+
+
+def _counted(kind):
+    with _lock:
+        EXTRACTIONS[kind] += 1
+
+
+class BenchVideoIE(InfoExtractor):
+    IE_NAME = 'benchvideo'
+    _VALID_URL = _BASE + r'/watch\?v=(?P<id>bench\d{6})'
+
+    def _real_extract(self, url):
+        base, video_id = self._match_valid_url(url).group('base', 'id')
+        _counted('video')
+        data = self._download_json(f"{base}/api/video/{video_id}", video_id)
+        data['webpage_url'] = url
+        return data
+
+
+class BenchPlaylistIE(InfoExtractor):
+    IE_NAME = 'benchplaylist'
+    _VALID_URL = _BASE + r'/playlist\?list=(?P<id>PLbench\d+)'
+
+    def _real_extract(self, url):
+        base, playlist_id = self._match_valid_url(url).group('base', 'id')
+        _counted('playlist')
+        data = self._download_json(f"{base}/api/playlist/{playlist_id}", playlist_id)
+        entries = [
+            self.url_result(f"{base}/watch?v={entry['id']}", BenchVideoIE, entry['id'], entry['title'])
+            for entry in data['entries']
+        ]
+        return self.playlist_result(entries, playlist_id, data['title'])
+
+
+def register() -> None:
+    from yt_dlp.extractor import import_extractors
+    from yt_dlp.globals import extractors
+
+    import_extractors()
+    extractors.value = {'BenchVideoIE': BenchVideoIE, 'BenchPlaylistIE': BenchPlaylistIE, **extractors.value}
+
+
+def reset() -> None:
+    with _lock:
+        for kind in EXTRACTIONS:
+            EXTRACTIONS[kind] = 0
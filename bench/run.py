@@ -0,0 +1,195 @@
+"""
+Offline benchmark of the download flows.
+
+Starts the local bench server, then runs each flow in its own process against it:
+
+    ty    ty.main with the whole playlist selected and the suggested format
+    ytdl  ytdl.Download.main downloading all videos with the suggested format
+    app   the Flask app: playlist page, format page per video, queued download jobs
+
+and reports wall time, extraction calls per video, bytes/sec and peak RSS.
+
+    python bench/run.py --videos 20 --size 2000000 --latency 0.02
+
+Formats of 2 MiB and more are fetched over several connections (segmented.py),
+YTDL_SEGMENTS=1 measures the same run with one connection per file:
+
+    YTDL_SEGMENTS=1 python bench/run.py --videos 4 --size 20000000 --flows ytdl
+"""
+
+import argparse
+import builtins
+import importlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FLOWS = ('ty', 'ytdl', 'app')
+RESULT_PREFIX = 'BENCH_RESULT '
+FORMAT_ID = '136'
+
+
+def scripted_input(answers):
+    answers = list(answers)
+
+    def fake_input(prompt=''):
+        answer = answers.pop(0) if answers else ''
+        print(f"{prompt}{answer}")
+        return answer
+
+    return fake_input
+
+
+def install_copy_merger():
+    """
+    Without ffmpeg yt-dlp refuses "+bestaudio" downloads. Stand in a merger that keeps the
+    video stream as the output, so the network side can still be measured.
+    """
+    from yt_dlp.postprocessor import FFmpegMergerPP
+
+    class CopyMergerPP(FFmpegMergerPP):
+        available = True
+
+        @classmethod
+        def pp_key(cls):
+            return 'Merger'  # Reported to postprocessor_hooks like the real merger
+
+        def run(self, info):
+            files = info['__files_to_merge']
+            os.replace(files[0], info['filepath'])
+            for extra in files[1:]:
+                os.remove(extra)
+            return [], info
+
+    importlib.import_module('yt_dlp.YoutubeDL').FFmpegMergerPP = CopyMergerPP
+
+
+def run_flow(flow, base_url, videos, work_dir):
+    import extractor
+    extractor.register()
+    if not shutil.which('ffmpeg'):
+        install_copy_merger()
+
+    playlist_url = f"{base_url}/playlist?list=PLbench{videos}"
+    os.chdir(work_dir)
+
+    if flow == 'ty':
+        import ty
+        builtins.input = scripted_input([''])  # accept the suggested format
+        ty.main(playlist_url, f"1-{videos}")
+
+    elif flow == 'ytdl':
+        import ytdl
+        builtins.input = scripted_input(['yes', ''])  # all videos, suggested format
+        ytdl.Download(home=work_dir).main(playlist_url)
+
+    elif flow == 'app':
+        import app
+        client = app.app.test_client()
+        page = client.post('/', data={'url': playlist_url}, follow_redirects=True)
+        assert page.status_code == 200, page.status_code
+        cursor = app.PAGE_SIZE + 1 if videos > app.PAGE_SIZE else None
+        while cursor:  # the rest of the listing, page by page like the playlist view's "Load more"
+            listing = client.get('/playlist/entries', query_string={'url': playlist_url, 'cursor': cursor})
+            cursor = listing.get_json()['next_cursor']
+        jobs = []
+        for n in range(1, videos + 1):
+            video_url = f"{base_url}/watch?v=bench{n:06d}"
+            assert client.post('/', data={'url': video_url}, follow_redirects=True).status_code == 200
+            queued = client.post('/downloading', data={'url': video_url, 'f_id': FORMAT_ID},
+                                 headers={'Accept': 'application/json'})
+            jobs.append(queued.get_json()['status_url'])
+        for status_url in jobs:
+            while client.get(status_url).get_json()['status'] not in ('finished', 'failed'):
+                time.sleep(0.01)
+
+    return {
+        'extractions': dict(extractor.EXTRACTIONS),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def child_main(args):
+    sys.path[:0] = [REPO_DIR, BENCH_DIR]
+    result = run_flow(args.child, args.server, args.videos, args.work_dir)
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+def run_child(flow, server, videos, verbose):
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{flow}_")
+    env = dict(os.environ,
+               YTDL_CACHE_PATH=os.path.join(work_dir, 'cache.sqlite3'),
+               YTDL_STORE_DIR=os.path.join(work_dir, 'store'),
+               YTDL_COORDINATION_PATH=os.path.join(work_dir, 'coordination.sqlite3'),
+               YTDL_HOST_RATE=os.environ.get('YTDL_HOST_RATE', '0'),  # measure the flows, not the pacing
+               YTDL_DOWNLOAD_DIR=os.path.join(work_dir, 'downloads'))
+    before = server.bytes_served
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', flow, '--server', server.base_url,
+         '--videos', str(videos), '--work-dir', work_dir],
+        env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    if verbose or proc.returncode:
+        sys.stderr.write(proc.stdout + proc.stderr)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if proc.returncode or not lines:
+        return {'flow': flow, 'error': f"exit code {proc.returncode}"}
+
+    result = json.loads(lines[-1][len(RESULT_PREFIX):])
+    transferred = server.bytes_served - before
+    return {
+        'flow': flow,
+        'wall_s': round(wall, 3),
+        'extractions_per_video': round(sum(result['extractions'].values()) / videos, 2),
+        'bytes_per_s': int(transferred / wall),
+        'peak_rss_mb': round(result['peak_rss_kb'] / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--videos', type=int, default=10, help="playlist length")
+    parser.add_argument('--size', type=int, default=1024 * 1024, help="bytes of the 1080p format of each video")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--flows', default=','.join(FLOWS), help="comma separated subset of " + ','.join(FLOWS))
+    parser.add_argument('--json', action='store_true', help="print results as JSON lines")
+    parser.add_argument('--verbose', action='store_true', help="show the flows' own output")
+    parser.add_argument('--child', choices=FLOWS, help=argparse.SUPPRESS)
+    parser.add_argument('--server', help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child_main(args)
+
+    sys.path.insert(0, BENCH_DIR)
+    from server import BenchServer
+
+    server = BenchServer(media_size=args.size, latency=args.latency).start()
+    try:
+        for flow in args.flows.split(','):
+            result = run_child(flow.strip(), server, args.videos, args.verbose)
+            if args.json:
+                print(json.dumps(result))
+            elif 'error' in result:
+                print(f"{flow:5} failed: {result['error']}")
+            else:
+                print(f"{flow:5} {result['wall_s']:8.2f} s  {result['extractions_per_video']:5.2f} extractions/video  "
+                      f"{result['bytes_per_s'] / 1e6:8.2f} MB/s  {result['peak_rss_mb']:7.1f} MB peak RSS")
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
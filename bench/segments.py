@@ -0,0 +1,111 @@
+"""
+Checks of the segmented download engine (segmented.py) against the bench server:
+
+    whole     a fresh download is byte for byte what the server sends
+    resume    a download whose connections were all cut off continues from its
+              .part file and segment state, and fetches only what is missing
+    prefix    a .part file yt-dlp wrote front to back is continued, not overwritten
+    fallback  abandon() leaves a .part file yt-dlp can continue from its end
+
+Exits with 1 if any check fails.
+
+    python bench/segments.py --size 8000000 --connections 4
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FORMAT_ID = '137'  # the largest format, media_size bytes
+
+
+def check(name, ok, detail):
+    print(f"{name:9} {'ok' if ok else 'FAILED'}  {detail}")
+    return ok
+
+
+def content(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=8 * 1024 * 1024, help="bytes of the downloaded file")
+    parser.add_argument('--connections', type=int, default=4, help="segments fetched at once")
+    args = parser.parse_args()
+
+    sys.path[:0] = [REPO_DIR, BENCH_DIR]
+    import segmented
+    from retry import RetryPolicy
+    from server import BenchServer, media_bytes
+
+    server = BenchServer(media_size=args.size).start()
+    work_dir = tempfile.mkdtemp(prefix='bench_segments_')
+    url = f"{server.base_url}/media/bench000001/{FORMAT_ID}"
+    size = server.format_size(FORMAT_ID)
+    expected = media_bytes(size)
+    min_segment = max(1, size // (2 * args.connections))
+    results = []
+
+    def download(name, retry=RetryPolicy(max_attempts=1)):
+        filepath = os.path.join(work_dir, name)
+        return segmented.SegmentedDownload(url, size, filepath, connections=args.connections,
+                                           min_segment=min_segment, retry=retry)
+
+    def served(fn):
+        before = server.bytes_served
+        fn()
+        return server.bytes_served - before
+
+    try:
+        whole = download('whole.mp4')
+        sent = served(whole.run)
+        results.append(check('whole', content(whole.filepath) == expected and sent == size,
+                             f"{sent} of {size} bytes sent"))
+
+        # Every connection is dropped a quarter into its segment, the run gives up
+        server.cut_after = size // (4 * args.connections)
+        cut = download('resume.mp4')
+        try:
+            cut.run()
+        except Exception:
+            pass
+        server.cut_after = None
+        kept = os.path.exists(cut.tmpfilename) and os.path.exists(cut.statefile)
+        written = sum(next_byte - start for start, next_byte, _ in segmented.load_state(cut.tmpfilename, size) or [])
+        resumed = download('resume.mp4')
+        sent = served(resumed.run)
+        results.append(check('resume', kept and written and content(resumed.filepath) == expected
+                             and sent == size - written, f"{written} bytes kept, {sent} more sent"))
+
+        prefix = download('prefix.mp4')
+        with open(prefix.tmpfilename, 'wb') as f:
+            f.write(expected[:size // 3])
+        sent = served(prefix.run)
+        results.append(check('prefix', content(prefix.filepath) == expected and sent == size - size // 3,
+                             f"{size // 3} bytes kept, {sent} more sent"))
+
+        server.cut_after = size // (4 * args.connections)
+        failed = download('fallback.mp4')
+        try:
+            failed.run()
+        except Exception:
+            pass
+        server.cut_after = None
+        segmented.abandon(failed.filepath)
+        left = content(failed.tmpfilename)
+        results.append(check('fallback', left and left == expected[:len(left)]
+                             and not os.path.exists(failed.statefile), f"{len(left)} bytes left for yt-dlp"))
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
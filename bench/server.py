@@ -0,0 +1,185 @@
+"""
+Local stand-in for YouTube used by the benchmarks.
+
+Serves synthetic playlist and video metadata as JSON and synthetic media
+files of a configurable size, with an optional per-request latency and
+HTTP Range support, and counts requests and bytes served. Setting cut_after
+drops every media response after that many bytes, like a flaky connection.
+"""
+
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Formats every synthetic video offers: (format_id, ext, height, vcodec, acodec, share of the media size)
+FORMATS = [
+    ('160', 'mp4', 144, 'avc1.4d400c', 'none', 0.05),
+    ('134', 'mp4', 360, 'avc1.4d401e', 'none', 0.15),
+    ('135', 'mp4', 480, 'avc1.4d401f', 'none', 0.25),
+    ('136', 'mp4', 720, 'avc1.4d401f', 'none', 0.5),
+    ('137', 'mp4', 1080, 'avc1.640028', 'none', 1.0),
+    ('18', 'mp4', 360, 'avc1.42001E', 'mp4a.40.2', 0.2),
+    ('140', 'm4a', None, 'none', 'mp4a.40.2', 0.1),
+]
+
+_CHUNK = bytes(range(256)) * 256
+
+
+def media_bytes(size: int) -> bytes:
+    """
+    :return: content of a media file of that size, as the server sends it
+    """
+    return (_CHUNK * (size // len(_CHUNK) + 1))[:size]
+
+
+def video_id(number: int) -> str:
+    return f"bench{number:06d}"
+
+
+class BenchServer:
+    def __init__(self, media_size: int = 1024 * 1024, latency: float = 0.0, port: int = 0):
+        """
+        :param media_size: size in bytes of the largest format of each video
+        :param latency: seconds added before answering any request
+        """
+        self.media_size = media_size
+        self.latency = latency
+        self.cut_after = None  # bytes of a media response sent before the connection is dropped
+        self.requests = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def playlist_url(self, count: int) -> str:
+        return f"{self.base_url}/playlist?list=PLbench{count}"
+
+    def video_url(self, number: int) -> str:
+        return f"{self.base_url}/watch?v={video_id(number)}"
+
+    def format_size(self, format_id: str) -> int:
+        share = next(f[5] for f in FORMATS if f[0] == format_id)
+        return max(1, int(self.media_size * share))
+
+    def start(self) -> 'BenchServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def count(self, sent: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.bytes_served += sent
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                if server.latency:
+                    time.sleep(server.latency)
+                m = re.match(r'^/api/playlist/PLbench(\d+)$', self.path)
+                if m:
+                    return self.send_json(server.playlist_data(int(m.group(1))), head)
+                m = re.match(r'^/api/video/(bench\d{6})$', self.path)
+                if m:
+                    return self.send_json(server.video_data(m.group(1)), head)
+                m = re.match(r'^/media/(bench\d{6})/(\w+)$', self.path)
+                if m and any(f[0] == m.group(2) for f in FORMATS):
+                    return self.send_media(server.format_size(m.group(2)), head)
+                self.send_error(404)
+
+            def send_json(self, data, head):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+                server.count(0 if head else len(body))
+
+            def send_media(self, size, head):
+                start, end = 0, size - 1
+                m = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+                if m and (m.group(1) or m.group(2)):
+                    if m.group(1):
+                        start = int(m.group(1))
+                        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+                    else:
+                        start = max(0, size - int(m.group(2)))
+                    if start >= size or start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f"bytes */{size}")
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return server.count(0)
+                    self.send_response(206)
+                    self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+                else:
+                    self.send_response(200)
+                length = end - start + 1
+                self.send_header('Content-Type', 'video/mp4')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(length))
+                self.end_headers()
+                if head:
+                    return server.count(0)
+                sent = 0
+                limit = length if server.cut_after is None else min(length, server.cut_after)
+                try:
+                    while sent < limit:
+                        offset = (start + sent) % len(_CHUNK)
+                        piece = _CHUNK[offset:offset + min(limit - sent, len(_CHUNK) - offset)]
+                        self.wfile.write(piece)
+                        sent += len(piece)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                if sent < length:
+                    self.close_connection = True
+                server.count(sent)
+
+        return Handler
+
+    def playlist_data(self, count: int):
+        return {
+            'id': f"PLbench{count}",
+            'title': f"Bench playlist of {count}",
+            'entries': [{'id': video_id(n), 'title': f"Bench video {n}"} for n in range(1, count + 1)],
+        }
+
+    def video_data(self, vid: str):
+        formats = []
+        for format_id, ext, height, vcodec, acodec, _ in FORMATS:
+            formats.append({
+                'format_id': format_id,
+                'url': f"{self.base_url}/media/{vid}/{format_id}",
+                'ext': ext,
+                'height': height,
+                'width': height * 16 // 9 if height else None,
+                'vcodec': vcodec,
+                'acodec': acodec,
+                'filesize': self.format_size(format_id),
+                'tbr': self.format_size(format_id) * 8 / 1000 / 60,
+                'protocol': 'https' if self.base_url.startswith('https') else 'http',
+            })
+        return {'id': vid, 'title': f"Bench video {int(vid[5:])}", 'duration': 60, 'formats': formats}
@@ -0,0 +1,166 @@
+"""
+Startup benchmark of the entry points.
+
+For each entry module (ty, ytdl, ytforflask, batch, app) measures the time to
+import it and the time from there to its first extraction, against the local
+bench server:
+
+    cold  a fresh interpreter, like a script run from the shell
+    warm  a process forked from one that ran pool.preload(), like a web worker
+          of a master started with gunicorn.conf.py (preload_app)
+
+Every run starts with an empty metadata cache, and the median of --reps runs
+is reported.
+
+    python bench/startup.py --reps 5
+"""
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+ENTRIES = ('ty', 'ytdl', 'ytforflask', 'batch', 'app')
+MODES = ('cold', 'warm')
+RESULT_PREFIX = 'STARTUP_RESULT '
+
+
+def fresh_env(work_dir):
+    return {
+        'YTDL_CACHE_PATH': os.path.join(work_dir, 'cache.sqlite3'),
+        'YTDL_STORE_DIR': os.path.join(work_dir, 'store'),
+        'YTDL_COORDINATION_PATH': os.path.join(work_dir, 'coordination.sqlite3'),
+        'YTDL_DOWNLOAD_DIR': os.path.join(work_dir, 'downloads'),
+        'YTDL_HOST_RATE': '0',
+    }
+
+
+def measure(entry, video_url, extractor=None):
+    """
+    :param extractor: the bench extractor module if it is loaded already
+    """
+    start = time.perf_counter()
+    importlib.import_module(entry)
+    imported = time.perf_counter()
+    if extractor is None:
+        import extractor  # imports yt_dlp, which is part of getting to the first extraction
+    extractor.register()
+    from cache import extract_info
+    assert extract_info(video_url, {'quiet': True})['id']
+    done = time.perf_counter()
+    return {'import_s': imported - start, 'first_extraction_s': done - imported}
+
+
+def warm_runs(entry, video_url, reps):
+    """
+    Preload once, then measure each run in a forked child.
+    """
+    import extractor
+    import pool
+    # Registered before the pooled instance is built, it would not know them otherwise.
+    # yt_dlp's plugin loading takes the "extractor" module name later, so this module is passed on.
+    extractor.register()
+    pool.preload()
+    results = []
+    for _ in range(reps):
+        work_dir = tempfile.mkdtemp(prefix=f"startup_{entry}_")
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            os.environ.update(fresh_env(work_dir))
+            try:
+                os.write(write_fd, json.dumps(measure(entry, video_url, extractor)).encode())
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            output = pipe.read()
+        os.waitpid(pid, 0)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not output:
+            raise RuntimeError(f"warm run of {entry} failed")
+        results.append(json.loads(output))
+    return results
+
+
+def child_main(args):
+    sys.path[:0] = [REPO_DIR, BENCH_DIR]
+    if args.warm:
+        results = warm_runs(args.child, args.video_url, args.reps)
+    else:
+        results = [measure(args.child, args.video_url)]
+    print(RESULT_PREFIX + json.dumps(results))
+
+
+def run_child(entry, video_url, warm, reps):
+    command = [sys.executable, os.path.abspath(__file__), '--child', entry, '--video-url', video_url]
+    work_dir = tempfile.mkdtemp(prefix=f"startup_{entry}_")
+    env = dict(os.environ, **fresh_env(work_dir))
+    if warm:
+        command += ['--warm', '--reps', str(reps)]
+    proc = subprocess.run(command, env=env, capture_output=True, text=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if proc.returncode or not lines:
+        sys.stderr.write(proc.stdout + proc.stderr)
+        raise RuntimeError(f"{entry} exited with {proc.returncode}")
+    return json.loads(lines[-1][len(RESULT_PREFIX):])
+
+
+def summarize(entry, mode, runs):
+    import_s = statistics.median(run['import_s'] for run in runs)
+    first_s = statistics.median(run['first_extraction_s'] for run in runs)
+    total_s = statistics.median(run['import_s'] + run['first_extraction_s'] for run in runs)
+    return {'entry': entry, 'mode': mode, 'import_s': round(import_s, 3),
+            'first_extraction_s': round(first_s, 3), 'total_s': round(total_s, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reps', type=int, default=5, help="runs per entry point and mode")
+    parser.add_argument('--entries', default=','.join(ENTRIES), help="comma separated subset of " + ','.join(ENTRIES))
+    parser.add_argument('--json', action='store_true', help="print results as JSON lines")
+    parser.add_argument('--child', choices=ENTRIES, help=argparse.SUPPRESS)
+    parser.add_argument('--video-url', help=argparse.SUPPRESS)
+    parser.add_argument('--warm', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child_main(args)
+
+    sys.path.insert(0, BENCH_DIR)
+    from server import BenchServer
+
+    server = BenchServer().start()
+    try:
+        for entry in args.entries.split(','):
+            entry = entry.strip()
+            for mode in MODES:
+                if mode == 'warm':
+                    runs = run_child(entry, server.video_url(1), True, args.reps)
+                else:
+                    runs = [run_child(entry, server.video_url(1), False, 1)[0] for _ in range(args.reps)]
+                result = summarize(entry, mode, runs)
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print(f"{entry:10} {mode:4}  import {result['import_s']:6.3f} s  "
+                          f"first extraction {result['first_extraction_s']:6.3f} s  total {result['total_s']:6.3f} s")
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+Metadata cache shared by every extract_info call site.
+
+Two tiers:
+1. In-memory LRU (per process), bounded by entry count and by the JSON size
+   of the info dicts it holds (YTDL_CACHE_MEMORY_BYTES).
+2. On-disk SQLite, bounded by total stored bytes.
+
+Entries are keyed by canonical video/playlist ID plus the extraction
+profile (full or flat), and every entry carries its own expiry time.
+
+Concurrent misses for the same key are coalesced: one caller extracts,
+the others wait for it and share its result (or its exception, which is
+not cached). Across processes sharing the SQLite file, a lock held through
+the Coordinator lets one process extract while the others wait for the
+result to show up on disk.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from urllib.parse import urlparse, parse_qs
+
+import metrics
+from coordination import coordinator, worker_id
+from pool import ydl_pool
+
+# Stream URLs inside a video's formats expire after a few hours, playlists change more often.
+VIDEO_TTL = 60 * 60
+PLAYLIST_TTL = 10 * 60
+MEMORY_BYTES = int(os.environ.get('YTDL_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+EXTRACTION_LOCK_TTL = 10  # renewed while the extraction runs, so a stalled holder loses it this soon
+
+CACHE_PATH = os.environ.get(
+    'YTDL_CACHE_PATH',
+    os.path.join(os.path.expanduser('~'), '.cache', 'ytdl_metadata.sqlite3')
+)
+
+_VIDEO_ID = re.compile(r'^[0-9A-Za-z_-]{11}$')
+
+
+def canonical_id(url: str) -> str:
+    """
+    Map the many spellings of a YouTube URL onto one key.
+
+    :param url: str
+    :return: "playlist:<id>", "video:<id>" or "url:<url>" for anything unrecognised
+    """
+    url = url.strip()
+    parsed = urlparse(url if '://' in url else 'https://' + url)
+    query = parse_qs(parsed.query)
+    host = parsed.netloc.lower()
+    path = [p for p in parsed.path.split('/') if p]
+
+    # yt-dlp extracts the whole playlist for watch?v=...&list=... unless told otherwise
+    if query.get('list'):
+        return f"playlist:{query['list'][0]}"
+    if query.get('v') and _VIDEO_ID.match(query['v'][0]):
+        return f"video:{query['v'][0]}"
+    if host.endswith('youtu.be') and path and _VIDEO_ID.match(path[0]):
+        return f"video:{path[0]}"
+    if len(path) >= 2 and path[0] in ('shorts', 'embed', 'live', 'v') and _VIDEO_ID.match(path[1]):
+        return f"video:{path[1]}"
+    if _VIDEO_ID.match(url):
+        return f"video:{url}"
+    return f"url:{url}"
+
+
+def cache_key(url: str, options: Dict) -> str:
+    profile = 'flat' if options.get('extract_flat') else 'full'
+    key = f"{canonical_id(url)}|{profile}"
+    if options.get('playlist_items'):
+        key += f"|items={options['playlist_items']}"
+    return key
+
+
+class MetadataCache:
+    def __init__(self, path: Optional[str] = CACHE_PATH, max_entries: int = 256,
+                 max_memory_bytes: int = MEMORY_BYTES, max_disk_bytes: int = 256 * 1024 * 1024):
+        """
+        :param path: SQLite file for the disk tier, None keeps the cache in memory only
+        :param max_entries: size of the in-memory LRU
+        :param max_memory_bytes: total JSON size of the info dicts in the in-memory LRU. A YouTube
+            info dict with its formats and captions runs to megabytes, so this is what bounds memory.
+        :param max_disk_bytes: total size of stored info JSON before the oldest entries are evicted
+        """
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> (expires, info, JSON size)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.path = path
+        self._db = None
+        self._pid = None
+
+    def _connect(self):
+        # A connection must not cross a fork (preload_app), every process opens its own on first use
+        if self.path and self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS info ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS info_accessed ON info (accessed)")
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            hit = self._memory.get(key)
+            if hit is not None:
+                expires, info, _ = hit
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    return info
+                self._forget(key)
+
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute("SELECT value, expires FROM info WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires = row
+            if expires <= now:
+                db.execute("DELETE FROM info WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE info SET accessed = ? WHERE key = ?", (now, key))
+            db.commit()
+            info = json.loads(value)
+            self._remember(key, expires, info, len(value))
+            return info
+
+    def set(self, key: str, info: Dict, ttl: float) -> None:
+        expires = time.time() + ttl
+        value = json.dumps(info, default=str)
+        with self._lock:
+            self._remember(key, expires, info, len(value))
+            db = self._connect()
+            if db is None:
+                return
+            db.execute(
+                "INSERT OR REPLACE INTO info (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires, time.time())
+            )
+            self._evict_disk()
+            db.commit()
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._forget(key)
+            db = self._connect()
+            if db is not None:
+                db.execute("DELETE FROM info WHERE key = ?", (key,))
+                db.commit()
+
+    def _remember(self, key, expires, info, size):
+        self._forget(key)
+        if size > self.max_memory_bytes:
+            return  # Only on disk, it would push everything else out
+        self._memory[key] = (expires, info, size)
+        self._memory_bytes += size
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_memory_bytes:
+            _, (_, _, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted
+
+    def _forget(self, key):
+        hit = self._memory.pop(key, None)
+        if hit is not None:
+            self._memory_bytes -= hit[2]
+
+    def _evict_disk(self):
+        self._db.execute("DELETE FROM info WHERE expires <= ?", (time.time(),))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM info").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM info ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM info WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_disk_bytes:
+                break
+
+
+metadata_cache = MetadataCache()
+
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time, concurrent callers of the same key share its outcome.
+    """
+
+    class _Call:
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}  # key -> _Call in flight
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            metrics.count('ytdl_coalesced_total')
+            call.done.wait()
+        else:
+            try:
+                call.result = fn(*args)
+            except BaseException as e:
+                call.error = e
+            finally:
+                # Later callers start a new call (and see the cache the leader filled)
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+in_flight = SingleFlight()
+
+
+def extract_info(url: str, options: Optional[Dict] = None, ttl: Optional[float] = None) -> Dict:
+    """
+    Cached replacement for yt_dlp.YoutubeDL(options).extract_info(url, download=False).
+
+    The returned dict is shared with the cache, callers must copy it before modifying it.
+    """
+    options = dict(options or {'quiet': True})
+    key = cache_key(url, options)
+    info = metadata_cache.get(key)
+    if info is not None:
+        metrics.count('ytdl_cache_hits_total')
+        return info
+
+    # 'in_playlist' extracts a single video fully, so a video's full entry serves both profiles
+    full_key = None
+    if options.get('extract_flat') == 'in_playlist':
+        full_key = cache_key(url, {k: v for k, v in options.items() if k != 'extract_flat'})
+        info = metadata_cache.get(full_key)
+        if info is not None and 'entries' not in info:
+            metrics.count('ytdl_cache_hits_total')
+            return info
+
+    return in_flight.do(key, _extract, url, options, key, full_key, ttl)
+
+
+def _extract(url, options, key, full_key, ttl):
+    # A call that finished just before this one started has already filled the cache
+    info = metadata_cache.get(key)
+    if info is not None:
+        metrics.count('ytdl_cache_hits_total')
+        return info
+
+    lock = 'extract:' + key
+    owner = worker_id()
+    while not coordinator.try_lock(lock, owner, ttl=EXTRACTION_LOCK_TTL):
+        # Another process is extracting it, its result lands in the shared disk tier
+        time.sleep(0.2)
+        info = metadata_cache.get(key)
+        if info is not None:
+            metrics.count('ytdl_coalesced_total')
+            return info
+    stop = threading.Event()
+    renewer = threading.Thread(target=_renew, args=(lock, owner, stop), name='extract-lock', daemon=True)
+    renewer.start()
+    try:
+        return _extract_locked(url, options, key, full_key, ttl)
+    finally:
+        stop.set()
+        # A renewal after the unlock would hold the lock again
+        renewer.join()
+        coordinator.unlock(lock, owner)
+
+
+def _renew(lock, owner, stop):
+    while not stop.wait(EXTRACTION_LOCK_TTL / 3):
+        try:
+            coordinator.try_lock(lock, owner, ttl=EXTRACTION_LOCK_TTL)
+        except Exception as e:
+            print(f"Could not renew {lock}: {e}")
+
+
+def _extract_locked(url, options, key, full_key, ttl):
+    # The process that held the lock before may have just stored it
+    info = metadata_cache.get(key)
+    if info is not None:
+        metrics.count('ytdl_cache_hits_total')
+        return info
+
+    metrics.count('ytdl_extractions_total')
+    with metrics.timer('extraction'), ydl_pool.acquire(options) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+    playlist = info.get('_type') == 'playlist' or 'entries' in info
+    if ttl is None:
+        ttl = PLAYLIST_TTL if playlist else VIDEO_TTL
+    metadata_cache.set(key, info, ttl)
+    if full_key and not playlist:
+        metadata_cache.set(full_key, info, ttl)
+    return info
@@ -0,0 +1,310 @@
+"""
+Job state shared by every web worker process.
+
+The Coordinator is the only place jobs live, so any worker can take a job,
+and any worker can answer for it:
+
+- Leasing: a worker leases the oldest queued job for LEASE_TTL seconds and
+  renews the lease with a heartbeat while it works on it. The lease of a
+  worker that died runs out, and another worker takes the job over.
+- Dedup: a job for a URL and format that is already queued or running is
+  returned instead of a second one being created.
+- Locks: short named leases, e.g. so only one process extracts a video while
+  the others wait for it in the shared metadata cache. The holder renews a
+  lock while it needs it, and a lock whose holder died is taken over.
+- Reservations: disk space promised to admitted downloads (see sink.py), per
+  device, so every process admits against the same free space. What a
+  download has written is taken off its reservation, the disk's free space
+  accounts for it already.
+
+SQLiteCoordinator keeps all of it in one SQLite file in WAL mode, which is
+enough for several processes on one host. WAL needs shared memory, so the file
+must not be shared between hosts over a network filesystem: running workers on
+several hosts takes a networked backend (Redis, Postgres, ...) that implements
+the same methods.
+"""
+
+import os
+import socket
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+COORDINATION_PATH = os.environ.get(
+    'YTDL_COORDINATION_PATH',
+    os.path.join(os.path.expanduser('~'), '.cache', 'ytdl_coordination.sqlite3')
+)
+LEASE_TTL = float(os.environ.get('YTDL_LEASE_TTL', 30))
+MAX_LEASES = 3  # a job whose worker died this often is failed instead of handed out again
+RETENTION = 7 * 24 * 60 * 60  # finished and failed jobs are forgotten after this long
+# A reservation is dropped with the process that holds it, or after this long for a process on another host
+RESERVATION_TTL = float(os.environ.get('YTDL_RESERVATION_TTL', 6 * 60 * 60))
+
+QUEUED, RUNNING, FINISHED, FAILED = 'queued', 'running', 'finished', 'failed'
+
+# Job fields a worker reports, besides status
+FIELDS = ('title', 'downloaded_bytes', 'total_bytes', 'speed', 'eta', 'filepath', 'part_file', 'streamable', 'error')
+
+
+def worker_id() -> str:
+    """
+    :return: identifies this process, also after a fork
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def alive(owner: str) -> bool:
+    """
+    :param owner: a worker_id()
+    :return: False if it is a process on this host that is gone, True otherwise
+    """
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Coordinator(ABC):
+    @abstractmethod
+    def submit(self, url: str, format_id: str, dedup_key: str) -> Tuple[Dict, bool]:
+        """
+        :param dedup_key: jobs with the same key are the same work, e.g. canonical video ID and format
+        :return: the job record, and False if it is an identical job that was already queued or running
+        """
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def lease(self, owner: str, ttl: float = LEASE_TTL) -> Optional[Dict]:
+        """
+        Take the oldest queued job, or a running one whose lease ran out.
+
+        :return: the job record, now running and owned by owner, None if there is nothing to do
+        """
+
+    @abstractmethod
+    def update(self, job_id: str, owner: str, ttl: float = LEASE_TTL, **fields) -> bool:
+        """
+        Report a leased job's state and renew its lease, which makes it the heartbeat as well.
+        A finished or failed status ends the lease.
+
+        :param fields: status and any of FIELDS
+        :return: False if owner no longer holds the lease
+        """
+
+    @abstractmethod
+    def try_lock(self, name: str, owner: str, ttl: float = LEASE_TTL) -> bool:
+        """
+        Take the lock, or renew it if owner holds it already. A lock held by a process
+        that is no longer alive() is taken over before it runs out.
+
+        :return: True if owner holds the lock now, it runs out after ttl unless taken again
+        """
+
+    @abstractmethod
+    def unlock(self, name: str, owner: str) -> None:
+        ...
+
+    @abstractmethod
+    def reserve(self, device: str, size: int, available: int, owner: str) -> Tuple[Optional[str], int]:
+        """
+        Reserve size bytes on device if they fit into available next to everything reserved there already.
+
+        :param available: bytes that may be reserved on device in total
+        :return: the reservation's ID, None if it does not fit, and the bytes reserved on device by others
+        """
+
+    @abstractmethod
+    def report_written(self, reservation_id: str, written: int) -> None:
+        """
+        :param written: bytes the reservation's download has written so far, they are no longer counted as reserved
+        """
+
+    @abstractmethod
+    def release(self, reservation_id: str) -> None:
+        ...
+
+
+class SQLiteCoordinator(Coordinator):
+    def __init__(self, path: str = COORDINATION_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+
+    def _connect(self):
+        # A connection must not cross a fork, every process opens its own
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, dedup_key TEXT NOT NULL, url TEXT NOT NULL, format_id TEXT NOT NULL, "
+                "status TEXT NOT NULL, title TEXT, downloaded_bytes INTEGER, total_bytes INTEGER, speed REAL, "
+                "eta REAL, filepath TEXT, part_file TEXT, streamable INTEGER, error TEXT, owner TEXT, "
+                "lease_expires REAL, leases INTEGER NOT NULL DEFAULT 0, version INTEGER NOT NULL DEFAULT 0, "
+                "created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS jobs_in_flight ON jobs (dedup_key) "
+                f"WHERE status IN ('{QUEUED}', '{RUNNING}')"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS reservations (id TEXT PRIMARY KEY, device TEXT NOT NULL, "
+                "size INTEGER NOT NULL, written INTEGER NOT NULL DEFAULT 0, owner TEXT NOT NULL, "
+                "expires REAL NOT NULL)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(reservations)")]
+            if 'written' not in columns:
+                self._db.execute("ALTER TABLE reservations ADD COLUMN written INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("CREATE INDEX IF NOT EXISTS reservations_device ON reservations (device)")
+            self._pid = os.getpid()
+        return self._db
+
+    def _transaction(self, fn, *args):
+        with self._lock:
+            db = self._connect()
+            # IMMEDIATE takes the write lock up front, so two processes never lease the same job
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(db, *args)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return result
+
+    @staticmethod
+    def _record(db, job_id):
+        cursor = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        record = dict(zip((column[0] for column in cursor.description), row))
+        record['streamable'] = bool(record['streamable'])
+        return record
+
+    def submit(self, url: str, format_id: str, dedup_key: str) -> Tuple[Dict, bool]:
+        def submit(db):
+            row = db.execute(
+                "SELECT id FROM jobs WHERE dedup_key = ? AND status IN (?, ?)", (dedup_key, QUEUED, RUNNING)
+            ).fetchone()
+            if row is not None:
+                return self._record(db, row[0]), False
+            now = time.time()
+            db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?", (FINISHED, FAILED, now - RETENTION))
+            job_id = uuid.uuid4().hex
+            db.execute(
+                "INSERT INTO jobs (id, dedup_key, url, format_id, status, downloaded_bytes, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?)", (job_id, dedup_key, url, format_id, QUEUED, now, now)
+            )
+            return self._record(db, job_id), True
+
+        return self._transaction(submit)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            return self._record(self._connect(), job_id)
+
+    def lease(self, owner: str, ttl: float = LEASE_TTL) -> Optional[Dict]:
+        def lease(db):
+            now = time.time()
+            # Abandoned too often, most likely the job itself takes its workers down
+            db.execute(
+                "UPDATE jobs SET status = ?, error = 'abandoned by its workers', owner = NULL, updated = ?, "
+                "version = version + 1 WHERE status = ? AND lease_expires < ? AND leases >= ?",
+                (FAILED, now, RUNNING, now, MAX_LEASES)
+            )
+            row = db.execute(
+                "SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY created LIMIT 1",
+                (QUEUED, RUNNING, now)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = ?, owner = ?, lease_expires = ?, leases = leases + 1, updated = ?, "
+                "version = version + 1 WHERE id = ?", (RUNNING, owner, now + ttl, now, row[0])
+            )
+            return self._record(db, row[0])
+
+        return self._transaction(lease)
+
+    def update(self, job_id: str, owner: str, ttl: float = LEASE_TTL, **fields) -> bool:
+        unknown = set(fields) - set(FIELDS) - {'status'}
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        now = time.time()
+        done = fields.get('status') in (FINISHED, FAILED)
+        fields.update(lease_expires=None if done else now + ttl, updated=now)
+        if done:
+            fields['owner'] = None
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        with self._lock:
+            cursor = self._connect().execute(
+                f"UPDATE jobs SET {assignments}, version = version + 1 WHERE id = ? AND owner = ?",
+                list(fields.values()) + [job_id, owner]
+            )
+        return cursor.rowcount == 1
+
+    def try_lock(self, name: str, owner: str, ttl: float = LEASE_TTL) -> bool:
+        def try_lock(db):
+            now = time.time()
+            row = db.execute("SELECT owner, expires FROM locks WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now and alive(row[0]):
+                return False
+            db.execute("INSERT OR REPLACE INTO locks (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + ttl))
+            return True
+
+        return self._transaction(try_lock)
+
+    def unlock(self, name: str, owner: str) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    def reserve(self, device: str, size: int, available: int, owner: str) -> Tuple[Optional[str], int]:
+        def reserve(db):
+            now = time.time()
+            db.execute("DELETE FROM reservations WHERE expires < ?", (now,))
+            owners = [row[0] for row in db.execute("SELECT DISTINCT owner FROM reservations WHERE device = ?",
+                                                   (device,))]
+            for holder in owners:
+                if not alive(holder):
+                    db.execute("DELETE FROM reservations WHERE owner = ?", (holder,))
+            reserved = db.execute("SELECT COALESCE(SUM(MAX(size - written, 0)), 0) FROM reservations "
+                                  "WHERE device = ?", (device,)).fetchone()[0]
+            if size + reserved > available:
+                return None, reserved
+            reservation_id = uuid.uuid4().hex
+            db.execute("INSERT INTO reservations (id, device, size, owner, expires) VALUES (?, ?, ?, ?, ?)",
+                       (reservation_id, device, size, owner, now + RESERVATION_TTL))
+            return reservation_id, reserved
+
+        return self._transaction(reserve)
+
+    def report_written(self, reservation_id: str, written: int) -> None:
+        with self._lock:
+            self._connect().execute("UPDATE reservations SET written = ? WHERE id = ?", (written, reservation_id))
+
+    def release(self, reservation_id: str) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+
+
+coordinator = SQLiteCoordinator()
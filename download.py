@@ -0,0 +1,255 @@
+"""
+Download straight from an info dict that was already extracted.
+
+ydl.download([url]) extracts the video page again before downloading. Handing the
+info dict we already hold to process_ie_result skips that round-trip.
+
+Downloads on the media store's filesystem go through the store: a video
+already stored in the requested format is linked into place instead of
+downloaded, and concurrent downloads of the same video and format wait for the
+first one.
+
+A "video+audio" format is fetched as two plain downloads in the calling thread,
+and the merge is queued on merge_stage. start_download returns as soon as the
+streams are fetched, so a download worker can start its next transfer while
+ffmpeg muxes the previous one.
+
+Every download is admitted by output_sink once its projected size fits on the
+disk, written into a staging directory and renamed into place when it is
+complete (see sink.py).
+
+A single plain HTTP format of known size is fetched over several connections
+(see segmented.py); "concurrent_fragment_downloads" in ydl_opts sets how many,
+1 turns it off.
+"""
+
+import copy
+import importlib
+import os
+import re
+import threading
+from concurrent.futures import Future
+from typing import Dict
+
+import metrics
+import segmented
+from cache import metadata_cache, cache_key
+from pool import ydl_pool
+from scheduler import MergeStage
+from sink import output_sink
+from store import media_store, store_key, link
+
+merge_stage = MergeStage()
+
+_lock = threading.Lock()
+_filling = {}  # store key -> Future of the download that is storing it
+
+# "136+bestaudio", not "136+140/best" or "bv*+ba[ext=m4a]"
+_SIMPLE_MERGE = re.compile(r'^[\w-]+(\+[\w-]+)+$')
+
+
+def download_info(info: Dict, ydl_opts: Dict) -> Dict:
+    """
+    :param info: full (not flat) info dict of a single video
+    :param ydl_opts: options for the downloading YoutubeDL
+    :return: the processed info dict, 'requested_downloads' holds the written file paths
+    """
+    return start_download(info, ydl_opts).result()
+
+
+def start_download(info: Dict, ydl_opts: Dict) -> Future:
+    """
+    download_info that returns once the streams are fetched.
+
+    :return: Future of the processed info dict, done once the output file is in place
+    :raises sink.InsufficientSpace: when the download does not fit on the disk
+    """
+    ydl_opts = dict(ydl_opts)
+    for key, hooks in metrics.hooks().items():
+        ydl_opts[key] = list(ydl_opts.get(key, [])) + hooks
+
+    staged = output_sink.admit(info, ydl_opts)
+    try:
+        future = _start_stored(info, staged.options, staged.final_dir)
+    except BaseException:
+        output_sink.release(staged)
+        raise
+    return then(then(future, staged.publish), _counted)
+
+
+def _counted(future):
+    metrics.count('ytdl_downloads_total', status='failed' if future.exception() else 'finished')
+    return future.result()
+
+
+def then(future: Future, fn) -> Future:
+    """
+    :return: Future of fn(future), called once future is done. Unlike a done callback,
+        whoever waits on it also waits for fn.
+    """
+    chained = Future()
+    future.add_done_callback(lambda f: _settle(chained, fn, f))
+    return chained
+
+
+def _settle(future, fn, *args):
+    try:
+        future.set_result(fn(*args))
+    except BaseException as e:
+        future.set_exception(e)
+    return future
+
+
+def _start_stored(info, ydl_opts, directory):
+    key = store_key(info, ydl_opts)
+    # Output elsewhere than on the store's filesystem could not be stored without a copy
+    if key is None or directory is None or not media_store.links_with(directory or '.'):
+        return _fetch(info, ydl_opts)
+
+    with _lock:
+        filling = _filling.get(key)
+        leader = filling is None and media_store.get(key) is None
+        if leader:
+            filling = _filling[key] = Future()
+
+    if leader:
+        future = _fetch(info, ydl_opts)
+        future.add_done_callback(lambda f: _settle(filling, _store, key, f))
+        return future
+    if filling is None:
+        return _settle(Future(), _link_stored, key, info, ydl_opts)
+
+    # Stored by the download in flight once it is done
+    future = Future()
+
+    def stored(f):
+        if f.exception() is not None:
+            future.set_exception(f.exception())
+        else:
+            _settle(future, _link_stored, key, info, ydl_opts)
+
+    filling.add_done_callback(stored)
+    return future
+
+
+def _store(key, future):
+    try:
+        result = future.result()
+        downloads = result.get('requested_downloads') or [{}]
+        if downloads[0].get('filepath') and os.path.exists(downloads[0]['filepath']):
+            media_store.put(key, downloads[0]['filepath'])
+        return result
+    finally:
+        with _lock:
+            del _filling[key]
+
+
+def _link_stored(key, info, ydl_opts):
+    from yt_dlp.utils import DownloadError
+
+    stored = media_store.get(key)
+    if stored is None:
+        raise DownloadError(f"{key} was not downloaded")
+    metrics.count('ytdl_store_hits_total')
+    ext = os.path.splitext(stored)[1][1:]
+    with ydl_pool.acquire(ydl_opts) as ydl:
+        filepath = ydl.prepare_filename(dict(info, ext=ext))
+    link(stored, filepath)
+    return dict(info, ext=ext, filepath=filepath, requested_downloads=[{'filepath': filepath, 'ext': ext}])
+
+
+def _merger():
+    # Looked up where YoutubeDL looks it up, so a replacement merger applies here as well
+    return importlib.import_module('yt_dlp.YoutubeDL').FFmpegMergerPP
+
+
+def _stream_template(outtmpl, fmt):
+    # Named after the whole format spec too, so two merges into the same output never share a stream file
+    suffix = '.' + re.sub(r'[^\w-]', '_', fmt) + '.f%(format_id)s'
+    outtmpl = outtmpl or '%(title)s [%(id)s].%(ext)s'
+    if outtmpl.endswith('.%(ext)s'):
+        return outtmpl[:-len('.%(ext)s')] + suffix + '.%(ext)s'
+    return outtmpl + suffix
+
+
+def _fetch(info, ydl_opts):
+    """
+    Download the streams of one video, queue their merge.
+    """
+    fmt = ydl_opts.get('format') or ''
+    if not _SIMPLE_MERGE.match(fmt) or isinstance(ydl_opts.get('outtmpl'), dict) or not _merger()(None).available:
+        # Single stream, or one yt-dlp has to resolve (and merge) itself
+        return _settle(Future(), _download_info, info, ydl_opts)
+
+    stream_opts = dict(ydl_opts, outtmpl=_stream_template(ydl_opts.get('outtmpl'), fmt))
+    streams = []
+    try:
+        for stream in fmt.split('+'):
+            result = _download_info(info, dict(stream_opts, format=stream))
+            streams.append(dict(result, filepath=result['requested_downloads'][0]['filepath']))
+    except BaseException as e:
+        future = Future()
+        future.set_exception(e)
+        return future
+    return merge_stage.submit(_merge, info, streams, ydl_opts)
+
+
+def _merge(info, streams, ydl_opts):
+    ext = ydl_opts.get('merge_output_format') or streams[0]['ext']
+    files = [stream['filepath'] for stream in streams]
+    with ydl_pool.acquire(ydl_opts) as ydl:
+        filepath = ydl.prepare_filename(dict(info, ext=ext))
+        merged = dict(info, ext=ext, filepath=filepath, requested_formats=streams, __files_to_merge=files)
+        # The merger reports to the YoutubeDL's postprocessor_hooks like yt-dlp's own merge step
+        _merger()(ydl).run(merged)
+    for path in files:
+        if os.path.exists(path):
+            os.remove(path)
+    return dict(info, ext=ext, filepath=filepath, requested_downloads=[{'filepath': filepath, 'ext': ext}])
+
+
+def _prefetch_segmented(ydl, info, ydl_opts):
+    """
+    Fetch a single plain HTTP format over several connections before yt-dlp gets to it;
+    yt-dlp then finds the file already downloaded. Anything that goes wrong is left to yt-dlp,
+    which continues the .part file from its last byte written without a gap.
+    """
+    connections = ydl_opts.get('concurrent_fragment_downloads') or segmented.CONNECTIONS
+    fmt = next((f for f in info.get('formats') or [] if f.get('format_id') == ydl_opts.get('format')), None)
+    if fmt is None:
+        return
+    filepath = ydl.prepare_filename(dict(info, **fmt))
+    if not segmented.segmentable(fmt, connections):
+        segmented.abandon(filepath)  # An earlier run did split it, yt-dlp continues its .part file
+        return
+    if os.path.exists(filepath):
+        return
+    download = segmented.SegmentedDownload(
+        fmt['url'], fmt['filesize'], filepath, headers=fmt.get('http_headers'), connections=connections,
+        progress_hooks=ydl_opts.get('progress_hooks'), info_dict=dict(info, **fmt))
+    try:
+        download.run()
+    except Exception as e:
+        print(f"Segmented download of {filepath} failed, downloading the rest in one piece: {e}")
+        segmented.abandon(filepath)
+
+
+def _download_info(info, ydl_opts):
+    from yt_dlp.utils import DownloadError
+
+    with ydl_pool.acquire(ydl_opts) as ydl:
+        try:
+            _prefetch_segmented(ydl, info, ydl_opts)
+            # process_ie_result fills in the dict it is given, keep the cached copy clean
+            info_copy = copy.deepcopy(info)
+            # The cached dict went through format selection once, a single format would inherit its pick
+            info_copy.pop('requested_formats', None)
+            info_copy.pop('requested_downloads', None)
+            return ydl.process_ie_result(info_copy, download=True)
+        except DownloadError as e:
+            url = info.get('webpage_url') or info.get('original_url')
+            # Stream URLs in an old info dict expire, re-extract once in that case
+            if not url or not any(code in str(e) for code in ('HTTP Error 403', 'HTTP Error 410')):
+                raise
+            metadata_cache.invalidate(cache_key(url, {}))
+            return ydl.extract_info(url, download=True)
@@ -0,0 +1,149 @@
+"""
+Compact per-video format index.
+
+Built once from info["formats"], it keeps only the fields the scripts look
+at in slotted records, with O(1) lookup by format_id and by height. Once a
+video's index exists the bulky format dicts are no longer needed.
+"""
+
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+# Heights the interactive and batch scripts offer, best first
+OFFERED_HEIGHTS = [2160, 1440, 1080, 720, 480, 360]
+
+
+class FormatRecord:
+    __slots__ = ('position', 'format_id', 'ext', 'width', 'height', 'vcodec', 'acodec',
+                 'filesize', 'tbr', 'resolution', 'host')
+
+    def __init__(self, position: int, fmt: Dict):
+        self.position = position
+        self.format_id = fmt.get('format_id')
+        self.ext = fmt.get('ext')
+        self.width = fmt.get('width')
+        self.height = fmt.get('height')
+        self.vcodec = fmt.get('vcodec')
+        self.acodec = fmt.get('acodec')
+        self.filesize = fmt.get('filesize') or fmt.get('filesize_approx')
+        self.tbr = fmt.get('tbr')
+        self.resolution = fmt.get('resolution') or self._resolution()
+        self.host = urlparse(fmt.get('url') or '').netloc
+
+    def _resolution(self) -> str:
+        if self.width and self.height:
+            return f"{self.width}x{self.height}"
+        if self.height:
+            return f"{self.height}p"
+        return 'audio only' if self.vcodec == 'none' else 'unknown'
+
+    def size_in_mb(self) -> str:
+        return f"{self.filesize / (1024 * 1024):.2f} MB" if self.filesize else "Unknown size"
+
+    def describe(self) -> str:
+        return f"{self.format_id}: {self.resolution}, {self.size_in_mb()}"
+
+
+class FormatIndex:
+    __slots__ = ('records', 'by_id', 'by_height')
+
+    def __init__(self, records: Iterable[FormatRecord]):
+        self.records = list(records)
+        self.by_id = {}
+        self.by_height = {}
+        for record in self.records:
+            self.by_id[record.format_id] = record
+            self.by_height.setdefault(record.height, []).append(record)
+
+    @classmethod
+    def from_info(cls, info: Dict) -> 'FormatIndex':
+        return cls(FormatRecord(i, fmt) for i, fmt in enumerate(info.get('formats') or []))
+
+    def __contains__(self, format_id: str) -> bool:
+        return format_id in self.by_id
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, format_id: str) -> Optional[FormatRecord]:
+        return self.by_id.get(format_id)
+
+    def at_height(self, height: int) -> List[FormatRecord]:
+        return self.by_height.get(height, [])
+
+    def select(self, heights: Iterable[int], ext: Optional[str] = None) -> List[FormatRecord]:
+        """
+        :return: formats at any of the given heights (and with the given ext), in yt-dlp's order
+        """
+        found = [record for height in set(heights) for record in self.at_height(height)
+                 if ext is None or record.ext == ext]
+        return sorted(found, key=lambda record: record.position)
+
+
+class CoverageMatrix:
+    """
+    Which format (and which resolution) is available in which video of a batch.
+
+    Built in one pass over the videos' FormatIndexes, so a single format can be
+    picked for the whole batch, with a per-video fallback, without probing any video again.
+    """
+
+    def __init__(self, indexes: Dict[int, FormatIndex]):
+        """
+        :param indexes: video number -> FormatIndex of that video
+        """
+        self.indexes = indexes
+        self.by_format = {}  # format_id -> set of video numbers
+        self.by_height = {}  # height -> set of video numbers
+        self.records = {}    # format_id -> a representative FormatRecord
+        for number, index in indexes.items():
+            for record in index.records:
+                self.by_format.setdefault(record.format_id, set()).add(number)
+                self.by_height.setdefault(record.height, set()).add(number)
+                self.records.setdefault(record.format_id, record)
+
+    def coverage(self, format_id: str) -> int:
+        return len(self.by_format.get(format_id, ()))
+
+    def candidates(self, heights: Iterable[int], ext: Optional[str] = None) -> List[FormatRecord]:
+        """
+        :return: formats at the given heights, the ones found in the most videos first
+        """
+        heights = set(heights)
+        found = [record for record in self.records.values()
+                 if record.height in heights and (ext is None or record.ext == ext)]
+        return sorted(found, key=lambda record: (-self.coverage(record.format_id), -record.height,
+                                                 -(record.tbr or 0)))
+
+    def suggest(self, heights: Iterable[int], ext: Optional[str] = None) -> Optional[str]:
+        candidates = self.candidates(heights, ext)
+        return candidates[0].format_id if candidates else None
+
+    def describe(self, heights: Iterable[int], ext: Optional[str] = None) -> List[str]:
+        total = len(self.indexes)
+        return [f"{record.describe()} - in {self.coverage(record.format_id)}/{total} videos"
+                for record in self.candidates(heights, ext)]
+
+    def fallback(self, number: int, format_id: str) -> Optional[str]:
+        """
+        :return: format_id if the video has it, otherwise its closest video format
+        (same ext preferred, then nearest height, lower before higher, then higher bitrate)
+        """
+        index = self.indexes[number]
+        if format_id in index:
+            return format_id
+        wanted = self.records.get(format_id)
+        videos = [record for record in index.records if record.height and record.vcodec != 'none']
+        if wanted is None or not videos:
+            return None
+        target = wanted.height or 0
+        best = min(videos, key=lambda record: (record.ext != wanted.ext,
+                                               abs(record.height - target), record.height > target,
+                                               -(record.tbr or 0)))
+        return best.format_id
+
+    def resolve(self, format_id: str) -> Dict[int, Optional[str]]:
+        """
+        :return: video number -> format to download for it (None if the video has no video formats)
+        """
+        return {number: self.fallback(number, format_id) for number in self.indexes}
@@ -0,0 +1,46 @@
+"""
+gunicorn settings for the web app:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The master imports the app, yt_dlp and its extractors once, before it forks
+the workers (preload_app), so a new or restarted worker answers its first
+request without importing anything. Workers share those pages with the master
+until they write to them; gc.freeze() keeps the garbage collector from writing
+to all of them at its first collection.
+
+Nothing that cannot cross a fork is opened in the master: the metadata cache,
+the coordinator and the job threads are set up per process on first use.
+
+Every worker writes its metrics to YTDL_METRICS_DIR (a fresh temporary
+directory unless set), and /metrics adds up all of them, whichever worker
+answers the scrape.
+"""
+
+import gc
+import glob
+import os
+import tempfile
+
+bind = os.environ.get('YTDL_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('YTDL_WEB_WORKERS', 4))
+# Progress streams and followed downloads hold a thread each for as long as they run
+worker_class = 'gthread'
+threads = int(os.environ.get('YTDL_WEB_THREADS', 16))
+timeout = 120
+preload_app = True
+
+# Read by metrics.py when the app is loaded, so set before that
+os.environ.setdefault('YTDL_METRICS_DIR', tempfile.mkdtemp(prefix='ytdl_metrics_'))
+
+
+def on_starting(server):
+    import pool
+    pool.preload()
+    # Counters of an earlier run in a YTDL_METRICS_DIR that was set would add up with this one's
+    for path in glob.glob(os.path.join(os.environ['YTDL_METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+
+def when_ready(server):
+    gc.freeze()
@@ -0,0 +1,334 @@
+"""
+Background download jobs for the web app.
+
+A POST only enqueues a job and returns its ID. Jobs run on a small thread
+pool, and yt-dlp's progress_hooks keep a snapshot of each job's state that
+the status endpoint and the Server-Sent Events stream read from.
+
+Jobs are kept by a Coordinator (see coordination.py) shared by all worker
+processes: a job is run by whichever process leases it first, an identical
+job already in flight is reused, and a process asked about a job another one
+runs follows its state through the Coordinator.
+
+A job whose format needs no merge writes its final file directly, so
+follow_download can hand its bytes to a client while they are being written.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional
+
+from cache import extract_info, canonical_id
+from coordination import Coordinator, coordinator, worker_id, FIELDS, QUEUED, RUNNING, FINISHED, FAILED
+from download import start_download
+from formats import FormatIndex
+from retry import call_with_retries
+
+DOWNLOAD_DIR = os.environ.get('YTDL_DOWNLOAD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads'))
+JOB_WORKERS = int(os.environ.get('YTDL_JOB_WORKERS', 2))
+MAX_FINISHED_JOBS = 1000
+CHUNK_SIZE = 256 * 1024
+SYNC_INTERVAL = 1.0  # how often leased jobs report to the Coordinator and other jobs are read back from it
+
+
+class Job:
+    def __init__(self, job_id: str, url: str, format_id: str):
+        self.id = job_id
+        self.url = url
+        self.format_id = format_id
+        self.status = QUEUED
+        self.title = None
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.speed = None
+        self.eta = None
+        self.filepath = None
+        self.part_file = None   # what yt-dlp is writing right now
+        self.streamable = False  # a single file download, no merge afterwards
+        self.error = None
+        self.created = time.time()
+        self.version = 0
+        self.synced_version = None  # the Coordinator's version of the job last read or written
+        self.abandoned = False  # its lease was lost, the local run stops and the job follows its record
+        self.changed = threading.Condition()
+
+    @classmethod
+    def from_record(cls, record: Dict) -> 'Job':
+        job = cls(record['id'], record['url'], record['format_id'])
+        job.created = record['created']
+        job.apply(record)
+        return job
+
+    def apply(self, record: Dict) -> None:
+        """
+        Take over the state of the job's Coordinator record.
+        """
+        if record['version'] != self.synced_version:
+            self.update(status=record['status'], **{field: record[field] for field in FIELDS})
+            self.synced_version = record['version']
+
+    def state(self) -> Dict:
+        with self.changed:
+            return dict({field: getattr(self, field) for field in FIELDS}, status=self.status)
+
+    def done(self) -> bool:
+        return self.status in (FINISHED, FAILED)
+
+    def update(self, **fields) -> None:
+        with self.changed:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self.changed.notify_all()
+
+    def progress_hook(self, d: Dict) -> None:
+        if self.abandoned:
+            from yt_dlp.utils import DownloadCancelled
+            raise DownloadCancelled(f"Job {self.id} was taken over by another worker")
+        if d['status'] == 'downloading':
+            self.update(
+                downloaded_bytes=d.get('downloaded_bytes') or 0,
+                total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+                speed=d.get('speed'),
+                eta=d.get('eta'),
+                part_file=d.get('tmpfilename') or d.get('filename'),
+            )
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'url': self.url,
+            'format_id': self.format_id,
+            'status': self.status,
+            'title': self.title,
+            'downloaded_bytes': self.downloaded_bytes,
+            'total_bytes': self.total_bytes,
+            'speed': self.speed,
+            'eta': self.eta,
+            'filename': os.path.basename(self.filepath) if self.filepath else None,
+            'streamable': self.streamable,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    def __init__(self, max_workers: int = JOB_WORKERS, download_dir: str = DOWNLOAD_DIR,
+                 coordinator: Coordinator = coordinator):
+        """
+        :param coordinator: where jobs are kept, shared with the other processes that run jobs
+        """
+        self.download_dir = download_dir
+        self.max_workers = max_workers
+        self.coordinator = coordinator
+        self.owner = None
+        self._jobs = OrderedDict()  # jobs this process runs or was asked about
+        self._leased = {}  # job ID -> Job this process holds the lease of
+        self._lock = threading.Lock()
+        self._work = threading.Event()
+        self._pid = None
+
+    def _start(self):
+        # Threads do not survive a fork, so every process starts its own on first use
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = worker_id()
+            self._leased.clear()
+        for n in range(self.max_workers):
+            threading.Thread(target=self._work_loop, name=f"job-{n}", daemon=True).start()
+        threading.Thread(target=self._sync_loop, name='job-sync', daemon=True).start()
+
+    def submit(self, url: str, format_id: str) -> Job:
+        """
+        :return: the new job, or the identical one that is already queued or running
+        """
+        self._start()
+        record, created = self.coordinator.submit(url, format_id, f"{canonical_id(url)}|{format_id}")
+        if created:
+            self._work.set()
+        return self._view(record)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._start()
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        record = self.coordinator.get(job_id)
+        return self._view(record) if record is not None else None
+
+    def _view(self, record):
+        with self._lock:
+            job = self._jobs.get(record['id'])
+            if job is None:
+                job = self._jobs[record['id']] = Job.from_record(record)
+                self._trim()
+            return job
+
+    def _trim(self):
+        # Forget the oldest finished jobs once there are too many, the Coordinator still has them
+        finished = [job_id for job_id, job in self._jobs.items() if job.done()]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _work_loop(self):
+        while True:
+            self._work.clear()
+            try:
+                record = self.coordinator.lease(self.owner)
+            except Exception as e:
+                print(f"Could not lease a job: {e}")
+                record = None
+            if record is None:
+                self._work.wait(SYNC_INTERVAL)
+                continue
+            job = self._view(record)
+            job.apply(record)
+            with self._lock:
+                self._leased[job.id] = job
+                job.abandoned = False
+            self._run(job)
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(SYNC_INTERVAL)
+            with self._lock:
+                leased = list(self._leased.values())
+                followed = [job for job in self._jobs.values() if not job.done() and job.id not in self._leased]
+            try:
+                # Progress goes out with the heartbeat, the lease is renewed while a job runs
+                for job in leased:
+                    self._report(job)
+                for job in followed:
+                    record = self.coordinator.get(job.id)
+                    if record is not None:
+                        job.apply(record)
+            except Exception as e:
+                print(f"Could not sync jobs: {e}")
+
+    def _report(self, job):
+        state = job.state()
+        if not self.coordinator.update(job.id, self.owner, **state):
+            # The lease ran out and another worker took the job over, it reports from now on.
+            # The local run is stopped and the job, no longer leased, is read back from its record.
+            print(f"Lost the lease of job {job.id}")
+            with self._lock:
+                self._leased.pop(job.id, None)
+                job.abandoned = True
+                job.synced_version = None
+        elif state['status'] in (FINISHED, FAILED):
+            with self._lock:
+                self._leased.pop(job.id, None)
+
+    def _run(self, job: Job):
+        job.update(status=RUNNING)
+        ydl_opts = {
+            'quiet': True,
+            'noprogress': True,
+            'merge_output_format': 'mp4',
+            'outtmpl': os.path.join(self.download_dir, job.id, "%(title)s.%(ext)s"),
+            'progress_hooks': [job.progress_hook],
+        }
+        try:
+            info = extract_info(job.url, {'quiet': True})
+            record = FormatIndex.from_info(info).get(job.format_id)
+            # A format that already carries audio is written as is, without waiting for a merge
+            streamable = record is not None and record.acodec not in (None, 'none')
+            ydl_opts['format'] = job.format_id if streamable else job.format_id + "+bestaudio"
+            if streamable:
+                # The file is read front to back while it is written, a segmented download fills it out of order
+                ydl_opts['concurrent_fragment_downloads'] = 1
+            job.update(title=info.get('title'), streamable=streamable)
+            self._report(job)
+            if job.abandoned:
+                return
+            # The worker is free once the streams are fetched, the job finishes after the merge.
+            # Throttling and dropped connections are retried with backoff before the job fails.
+            host = record.host if record is not None else None
+            future = call_with_retries(start_download, info, ydl_opts, host=host)
+            future.add_done_callback(lambda f: self._finish(job, f))
+        except Exception as e:
+            if not job.abandoned:
+                job.update(status=FAILED, error=str(e))
+                self._report(job)
+
+    def _finish(self, job: Job, future):
+        if job.abandoned:
+            return
+        if future.exception() is not None:
+            job.update(status=FAILED, error=str(future.exception()))
+        else:
+            downloads = future.result().get('requested_downloads') or [{}]
+            job.update(status=FINISHED, filepath=downloads[0].get('filepath'))
+        self._report(job)
+
+
+def stream_events(job: Job, keepalive: float = 15.0) -> Iterator[str]:
+    """
+    Server-Sent Events for one job: a "progress" event whenever its state changes,
+    ending with a "done" event once it finished or failed.
+    """
+    seen = -1
+    while True:
+        with job.changed:
+            if job.version == seen:
+                job.changed.wait(timeout=keepalive)
+            if job.version == seen:
+                state = None
+            else:
+                seen = job.version
+                state, done = job.to_dict(), job.done()
+
+        if state is None:
+            yield ": keepalive\n\n"
+            continue
+        event = 'done' if done else 'progress'
+        yield f"event: {event}\ndata: {json.dumps(state)}\n\n"
+        if done:
+            return
+
+
+def _open_download(job: Job):
+    while True:
+        with job.changed:
+            if job.done():
+                return open(job.filepath, 'rb') if job.status == FINISHED and job.filepath else None
+            if job.part_file:
+                # yt-dlp renames the .part file once it is complete
+                paths = [job.part_file]
+                if job.part_file.endswith('.part'):
+                    paths.append(job.part_file[:-len('.part')])
+                for path in paths:
+                    try:
+                        return open(path, 'rb')
+                    except FileNotFoundError:
+                        pass
+            job.changed.wait(timeout=1.0)
+
+
+def follow_download(job: Job, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    The bytes of a streamable job's file, following it while yt-dlp is still writing it.
+    Ends when the job is done and everything written has been sent.
+    """
+    f = _open_download(job)
+    if f is None:
+        return
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                yield chunk
+                continue
+            with job.changed:
+                if not job.done():
+                    job.changed.wait(timeout=1.0)
+                    continue
+            # Done, send whatever was written since the last read
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+            return
@@ -0,0 +1,128 @@
+"""
+Crash-safe journal of a playlist download.
+
+Every video of a job is a row in a small SQLite file next to the downloads,
+moving through pending -> downloading -> merged -> done (or failed). The row
+also remembers the .part file yt-dlp is writing, so after a crash the job can
+be picked up again: finished videos are skipped by a primary-key lookup and
+unfinished ones restart with the same output name, which lets yt-dlp continue
+their .part files.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from download import start_download, then
+
+PENDING, DOWNLOADING, MERGED, DONE, FAILED = 'pending', 'downloading', 'merged', 'done', 'failed'
+
+MANIFEST_NAME = '.ytdl_manifest.sqlite3'
+
+
+class Manifest:
+    def __init__(self, save_dir: str, job: str, name: str = MANIFEST_NAME):
+        """
+        :param save_dir: directory the job downloads into, the journal lives there too
+        :param job: identifies the job inside the journal, e.g. the canonical playlist ID
+        """
+        self.job = job
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(save_dir, name), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            "job TEXT NOT NULL, number INTEGER NOT NULL, url TEXT NOT NULL, title TEXT, "
+            "format_id TEXT, state TEXT NOT NULL, part_file TEXT, filepath TEXT, error TEXT, "
+            "updated REAL NOT NULL, PRIMARY KEY (job, number))"
+        )
+        self._db.commit()
+
+    def start(self, videos: List[Dict]) -> None:
+        """
+        Replace this job's journal with a new set of videos, all pending.
+
+        :param videos: dicts with number, url, title and format_id
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM videos WHERE job = ?", (self.job,))
+            self._db.executemany(
+                "INSERT INTO videos (job, number, url, title, format_id, state, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.job, v['number'], v['url'], v['title'], v['format_id'], PENDING, now) for v in videos]
+            )
+            self._db.commit()
+
+    def unfinished(self) -> List[Dict]:
+        """
+        :return: videos of this job that are not done, ordered by number
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT number, url, title, format_id, state, part_file FROM videos "
+                "WHERE job = ? AND state != ? ORDER BY number", (self.job, DONE)
+            ).fetchall()
+        return [dict(zip(('number', 'url', 'title', 'format_id', 'state', 'part_file'), row)) for row in rows]
+
+    def state(self, number: int) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM videos WHERE job = ? AND number = ?", (self.job, number)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, number: int, state: str, **fields) -> None:
+        """
+        :param fields: any of part_file, filepath, error
+        """
+        columns = ['state', 'updated'] + list(fields)
+        values = [state, time.time()] + list(fields.values())
+        assignments = ', '.join(f"{column} = ?" for column in columns)
+        with self._lock:
+            self._db.execute(
+                f"UPDATE videos SET {assignments} WHERE job = ? AND number = ?", values + [self.job, number]
+            )
+            self._db.commit()
+
+    def hooks(self, number: int) -> Dict:
+        """
+        :return: YoutubeDL options that journal the progress of one video
+        """
+        seen_parts = set()
+
+        def progress_hook(d):
+            if d['status'] == 'downloading' and d.get('tmpfilename') not in seen_parts:
+                seen_parts.add(d.get('tmpfilename'))
+                self.set_state(number, DOWNLOADING, part_file=d.get('tmpfilename'))
+
+        def postprocessor_hook(d):
+            if d['status'] == 'finished' and d.get('postprocessor') == 'Merger':
+                self.set_state(number, MERGED, filepath=d['info_dict'].get('filepath'))
+
+        return {'progress_hooks': [progress_hook], 'postprocessor_hooks': [postprocessor_hook]}
+
+    def start_download(self, number: int, info: Dict, ydl_opts: Dict) -> Future:
+        """
+        start_download with this video's progress journaled, it is done (or failed) once the Future is.
+        """
+        ydl_opts = dict(ydl_opts)
+        for key, hooks in self.hooks(number).items():
+            ydl_opts[key] = list(ydl_opts.get(key, [])) + hooks
+
+        def finished(future):
+            if future.exception() is not None:
+                self.set_state(number, FAILED, error=str(future.exception()))
+            else:
+                downloads = future.result().get('requested_downloads') or [{}]
+                self.set_state(number, DONE, filepath=downloads[0].get('filepath'))
+            return future.result()
+
+        return then(start_download(info, ydl_opts), finished)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,225 @@
+"""
+Per-phase timing and counters for the hot path.
+
+Phases are extraction, format_selection, download and merge. Extraction and
+format selection are timed by wrapping the calls; download and merge are timed
+from yt-dlp's progress_hooks and postprocessor_hooks (see hooks()). Everything
+is kept in one process-wide registry that renders as Prometheus text for the
+web app's /metrics route, or as a short summary at the end of a CLI run.
+
+A web app running as several worker processes sets YTDL_METRICS_DIR (as
+gunicorn.conf.py does): every process then writes its registry to a file of
+its own there about once a second, and /metrics adds up all of them, so any
+worker answers a scrape with the totals of the whole app. Without it, /metrics
+only covers the process that answers.
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+# Upper bounds in seconds, extraction and merges take seconds, downloads minutes
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+SHARED_DIR = os.environ.get('YTDL_METRICS_DIR')
+FLUSH_INTERVAL = 1.0
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self, shared_dir: Optional[str] = SHARED_DIR):
+        """
+        :param shared_dir: directory this process's registry is written to, for collect()
+        """
+        self.shared_dir = shared_dir
+        self._lock = threading.Lock()
+        self._histograms = {}  # phase -> Histogram
+        self._counters = {}    # (name, labels) -> value
+        self._changed = False
+        self._flusher_pid = None
+        self._flushing = threading.Lock()
+
+    def observe(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self._histograms.setdefault(phase, Histogram()).observe(seconds)
+            self._changed = True
+        self._share()
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._changed = True
+        self._share()
+
+    def snapshot(self) -> Tuple[Dict, Dict]:
+        with self._lock:
+            histograms = {phase: (list(h.counts), h.sum, h.count) for phase, h in self._histograms.items()}
+            return histograms, dict(self._counters)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._changed = True
+
+    def flush(self) -> None:
+        """
+        Write this process's registry to its file in shared_dir.
+        """
+        with self._flushing:
+            with self._lock:
+                self._changed = False
+            histograms, counters = self.snapshot()
+            os.makedirs(self.shared_dir, exist_ok=True)
+            path = os.path.join(self.shared_dir, f"{os.getpid()}.json")
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'histograms': histograms,
+                           'counters': [[name, labels, value] for (name, labels), value in counters.items()]}, f)
+            os.replace(path + '.tmp', path)
+
+    def _share(self):
+        # One flusher thread per process, also after a fork
+        if self.shared_dir is None or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            if self._changed:
+                self.flush()
+
+
+registry = Registry()
+
+
+def collect() -> Tuple[Dict, Dict]:
+    """
+    :return: histograms and counters of every process sharing the registry's shared_dir,
+        or of this process only
+    """
+    if registry.shared_dir is None:
+        return registry.snapshot()
+    registry.flush()
+    histograms, counters = {}, {}
+    for path in glob.glob(os.path.join(registry.shared_dir, '*.json')):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for phase, (counts, total, n) in data['histograms'].items():
+            merged = histograms.setdefault(phase, ([0] * len(BUCKETS), 0.0, 0))
+            histograms[phase] = ([a + b for a, b in zip(merged[0], counts)], merged[1] + total, merged[2] + n)
+        for name, labels, value in data['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+
+def observe(phase: str, seconds: float) -> None:
+    registry.observe(phase, seconds)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    registry.count(name, value, **labels)
+
+
+@contextmanager
+def timer(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - start)
+
+
+def hooks() -> Dict:
+    """
+    :return: YoutubeDL options timing the download and merge phases of one download
+    """
+    started = {}
+
+    def progress_hook(d):
+        # A file found already downloaded is reported finished too, without an elapsed time
+        if d['status'] == 'finished' and d.get('elapsed') is not None:
+            observe('download', d['elapsed'])
+            count('ytdl_downloaded_bytes_total', d.get('total_bytes') or d.get('downloaded_bytes') or 0)
+        elif d['status'] == 'error':
+            count('ytdl_download_errors_total')
+
+    def postprocessor_hook(d):
+        name = d.get('postprocessor')
+        if d['status'] == 'started':
+            started[name] = time.perf_counter()
+        elif d['status'] == 'finished' and name in started:
+            observe('merge' if name == 'Merger' else 'postprocess', time.perf_counter() - started.pop(name))
+
+    return {'progress_hooks': [progress_hook], 'postprocessor_hooks': [postprocessor_hook]}
+
+
+def _labels(labels) -> str:
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+
+def prometheus_text() -> str:
+    histograms, counters = collect()
+    lines = [
+        "# HELP ytdl_phase_seconds Time spent per phase.",
+        "# TYPE ytdl_phase_seconds histogram",
+    ]
+    for phase in sorted(histograms):
+        counts, total, n = histograms[phase]
+        cumulative = 0
+        for bound, c in zip(BUCKETS, counts):
+            cumulative += c
+            lines.append(f'ytdl_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+        lines.append(f'ytdl_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {n}')
+        lines.append(f'ytdl_phase_seconds_sum{{phase="{phase}"}} {total}')
+        lines.append(f'ytdl_phase_seconds_count{{phase="{phase}"}} {n}')
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (counter, labels), value in sorted(counters.items()):
+            if counter == name:
+                lines.append(f"{name}{_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> str:
+    """
+    :return: one line per phase and counter, for the end of a CLI run
+    """
+    histograms, counters = registry.snapshot()
+    lines = ["\nTiming summary:"]
+    for phase in sorted(histograms):
+        _, total, n = histograms[phase]
+        lines.append(f"  {phase:17} {n:5d} x  {total:9.2f} s total  {total / n:8.3f} s avg")
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f"  {name}{_labels(labels)} {value:g}")
+    return '\n'.join(lines)
@@ -0,0 +1,124 @@
+"""
+Pool of warmed yt_dlp.YoutubeDL instances, keyed by option profile.
+
+Building a YoutubeDL sets up the extractor registry, cookie jar and HTTP
+handlers; using it warms extractor instances and keeps HTTP connections open.
+The pool keeps instances per profile, i.e. per set of options (quiet metadata,
+flat listing, download with a given format), and hands each one to a single
+thread at a time.
+
+Per-call options that do not change the profile (the format, the output
+template and the progress/postprocessor hooks) are applied on checkout and
+removed on return, so e.g. the two streams of a split download and their
+merge all reuse the same instances.
+
+yt_dlp itself is imported on the first checkout, so scripts start without
+paying for it up front. preload() pays for it ahead of time instead, e.g. in a
+web server's master process before it forks its workers (gunicorn.conf.py).
+"""
+
+import importlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict
+
+# Idle instances kept per profile, and number of profiles kept at all
+POOL_SIZE = int(os.environ.get('YTDL_POOL_SIZE', 8))
+MAX_PROFILES = 16
+
+_PER_CALL = ('format', 'outtmpl', 'progress_hooks', 'postprocessor_hooks')
+
+
+def profile_key(options: Dict) -> str:
+    return json.dumps({k: v for k, v in options.items() if k not in _PER_CALL}, sort_keys=True, default=repr)
+
+
+class YoutubeDLPool:
+    def __init__(self, size: int = POOL_SIZE, max_profiles: int = MAX_PROFILES):
+        self.size = size
+        self.max_profiles = max_profiles
+        self._idle = OrderedDict()  # profile key -> list of idle instances
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, options: Dict):
+        """
+        with pool.acquire(options) as ydl: ... behaves like with yt_dlp.YoutubeDL(options) as ydl: ...
+        """
+        key = profile_key(options)
+        ydl = self._take(key)
+        if ydl is None:
+            import yt_dlp
+            ydl = yt_dlp.YoutubeDL({k: v for k, v in options.items() if k not in _PER_CALL})
+            ydl._pool_hooks = (list(ydl._progress_hooks), list(ydl._postprocessor_hooks))
+
+        self._apply(ydl, options)
+        try:
+            yield ydl
+        finally:
+            self._apply(ydl, {})
+            ydl.save_cookies()
+            self._give(key, ydl)
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, OrderedDict()
+        for instances in idle.values():
+            for ydl in instances:
+                ydl.close()
+
+    @staticmethod
+    def _apply(ydl, options):
+        progress_hooks, postprocessor_hooks = ydl._pool_hooks
+        ydl._progress_hooks = progress_hooks + list(options.get('progress_hooks', []))
+        ydl._postprocessor_hooks = postprocessor_hooks + list(options.get('postprocessor_hooks', []))
+        outtmpl = options.get('outtmpl', {})
+        ydl.params['outtmpl'] = dict(outtmpl) if isinstance(outtmpl, dict) else {'default': outtmpl}
+        ydl._parse_outtmpl()
+        # Same as YoutubeDL.__init__ does with params['format']
+        fmt = ydl.params['format'] = options.get('format')
+        ydl.format_selector = fmt if fmt in (None, '-') or callable(fmt) else ydl.build_format_selector(fmt)
+        ydl._num_downloads = 0
+
+    def _take(self, key):
+        with self._lock:
+            instances = self._idle.get(key)
+            if instances:
+                self._idle.move_to_end(key)
+                return instances.pop()
+        return None
+
+    def _give(self, key, ydl):
+        evicted = []
+        with self._lock:
+            instances = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(instances) < self.size:
+                instances.append(ydl)
+            else:
+                evicted.append(ydl)
+            while len(self._idle) > self.max_profiles:
+                evicted.extend(self._idle.popitem(last=False)[1])
+        for instance in evicted:
+            instance.close()
+
+
+def preload(profiles=({'quiet': True},)) -> None:
+    """
+    Import yt_dlp and its extractors now instead of on the first extraction, and pool an instance
+    per profile (the default one is extract_info's). Forked processes share all of it; the
+    instances are left unused, so they hold no connection yet that could cross the fork.
+    """
+    from yt_dlp.extractor import gen_extractor_classes
+    gen_extractor_classes()
+    # Behind the lazy extractor of the site most URLs are from
+    importlib.import_module('yt_dlp.extractor.youtube')
+    for options in profiles:
+        with ydl_pool.acquire(options):
+            pass
+
+
+ydl_pool = YoutubeDLPool()
@@ -0,0 +1,210 @@
+"""
+Retries for downloads that fail for reasons that go away by themselves.
+
+Errors are sorted into transient ones (throttling, 5xx, timeouts, dropped
+connections) and permanent ones (404, private or removed videos, missing
+formats, ...). Transient failures are retried with exponential backoff and
+full jitter, and a Retry-After sent by the server is honoured.
+
+A token bucket per media host spaces out download starts, so a large batch
+runs just under the host's request rate instead of running into 429s and
+backing off all at once.
+"""
+
+import os
+import random
+import re
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from http.client import IncompleteRead
+from typing import Callable, Optional
+
+import metrics
+
+HOST_RATE = float(os.environ.get('YTDL_HOST_RATE', 2.0))  # download starts per second and host, 0 for no limit
+HOST_BURST = int(os.environ.get('YTDL_HOST_BURST', 5))
+MAX_ATTEMPTS = int(os.environ.get('YTDL_MAX_ATTEMPTS', 5))
+
+TRANSIENT_STATUS = {403, 408, 425, 429, 500, 502, 503, 504}
+
+_PERMANENT = re.compile(
+    r'private video|video unavailable|has been removed|is not available|requested format is not available'
+    r'|unsupported url|sign in to confirm your age|members-only|ffmpeg is not installed', re.I)
+_TRANSIENT = re.compile(
+    r'timed out|connection (reset|aborted|refused)|temporary failure|incompleteread|remote end closed'
+    r'|too many requests|unable to download video data', re.I)
+_STATUS = re.compile(r'HTTP Error (\d{3})')
+
+
+def _chain(error: BaseException):
+    """
+    The error and what caused it, including the exception a yt-dlp DownloadError wraps.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        exc_info = getattr(error, 'exc_info', None)
+        wrapped = exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None
+        error = wrapped or error.__cause__ or error.__context__
+
+
+def http_status(error: BaseException) -> Optional[int]:
+    for e in _chain(error):
+        status = getattr(e, 'status', None) or getattr(e, 'code', None)
+        if isinstance(status, int) and 100 <= status < 600:
+            return status
+    match = _STATUS.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    :return: seconds from the Retry-After header of the response that failed, if any
+    """
+    for e in _chain(error):
+        headers = getattr(getattr(e, 'response', None), 'headers', None) or getattr(e, 'headers', None)
+        value = headers.get('Retry-After') if headers is not None else None
+        if value and value.strip().isdigit():
+            return float(value)
+    return None
+
+
+def is_transient(error: BaseException) -> bool:
+    status = http_status(error)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    text = str(error)
+    if _PERMANENT.search(text):
+        return False
+    if _TRANSIENT.search(text):
+        return True
+    return any(isinstance(e, (TimeoutError, ConnectionError, socket.timeout, IncompleteRead)) for e in _chain(error))
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS, base: float = 1.0, cap: float = 60.0):
+        """
+        :param max_attempts: attempts in total, including the first one
+        :param base: backoff of the first retry, doubled for every further one
+        :param cap: longest backoff
+        """
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, error: BaseException, attempt: int) -> Optional[float]:
+        """
+        :param attempt: the attempt that just failed, starting at 1
+        :return: seconds to wait before the next attempt, None to give up
+        """
+        if attempt >= self.max_attempts or not isinstance(error, Exception) or not is_transient(error):
+            return None
+        backoff = random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+        return max(backoff, retry_after(error) or 0)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """
+        Take a token, possibly one that has not been refilled yet.
+
+        :return: seconds until the token is there, 0 if it already is
+        """
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        time.sleep(self.reserve())
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hand out no tokens for the next `seconds`, e.g. after the host answered 429.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class HostLimiter:
+    def __init__(self, rate: float = HOST_RATE, burst: int = HOST_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def reserve(self, host: str) -> float:
+        return self._bucket(host).reserve() if self.rate > 0 else 0.0
+
+    def acquire(self, host: str) -> None:
+        time.sleep(self.reserve(host))
+
+    def pause(self, host: str, seconds: float) -> None:
+        if self.rate > 0:
+            self._bucket(host).pause(seconds)
+
+
+retry_policy = RetryPolicy()
+host_limiter = HostLimiter()
+
+
+def raise_failed(result) -> None:
+    """
+    A download that returned an already failed Future (see download.start_download) failed right away.
+    """
+    if isinstance(result, Future) and result.done() and result.exception() is not None:
+        raise result.exception()
+
+
+def throttled(error: BaseException) -> bool:
+    return http_status(error) == 429
+
+
+def call_with_retries(fn: Callable, *args, host: Optional[str] = None,
+                      policy: RetryPolicy = retry_policy, limiter: HostLimiter = host_limiter):
+    """
+    fn(*args), retried in the calling thread while it fails with transient errors.
+
+    :param host: media host fn downloads from, its token bucket is respected
+    """
+    attempt = 1
+    while True:
+        if host:
+            limiter.acquire(host)
+        try:
+            result = fn(*args)
+            raise_failed(result)
+            return result
+        except Exception as e:
+            delay = policy.delay(e, attempt)
+            if delay is None:
+                raise
+            metrics.count('ytdl_retries_total')
+            if host and throttled(e):
+                limiter.pause(host, delay)
+            print(f"Retrying in {delay:.1f} s after: {e}")
+            time.sleep(delay)
+        attempt += 1
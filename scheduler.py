@@ -0,0 +1,254 @@
+"""
+Bounded concurrent scheduler for the download phase of a playlist.
+
+At most max_workers downloads run at once, and at most per_host of them
+against the same media host. Each job carries its video number from the
+moment it is submitted, so the "NN_" file name prefix does not depend on
+which job finishes first.
+
+A job may return a Future for a later stage of its work (the merge of its
+streams, see MergeStage). The job's network slot is free again as soon as it
+returns, and wait() also waits for that Future.
+
+Starts are also paced by a token bucket per host, and a job that fails with a
+transient error goes back into the queue after a backoff (see retry.py)
+without holding a worker while it waits.
+
+hydrate_videos() is the metadata phase before it: full infos for the flat
+entries of a playlist, METADATA_WORKERS extractions at a time.
+"""
+
+import os
+import threading
+import time
+from collections import deque, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import metrics
+from cache import extract_info
+from retry import RetryPolicy, HostLimiter, retry_policy, host_limiter, raise_failed, throttled
+
+DOWNLOAD_WORKERS = int(os.environ.get('YTDL_DOWNLOAD_WORKERS', 4))
+PER_HOST_LIMIT = int(os.environ.get('YTDL_PER_HOST_LIMIT', 3))
+METADATA_WORKERS = int(os.environ.get('YTDL_METADATA_WORKERS', 8))
+MERGE_WORKERS = int(os.environ.get('YTDL_MERGE_WORKERS', os.cpu_count() or 2))
+
+
+class _Job:
+    __slots__ = ('video_number', 'host', 'fn', 'args', 'future', 'attempt', 'not_before', 'reserved')
+
+    def __init__(self, video_number, host, fn, args):
+        self.video_number = video_number
+        self.host = host
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.attempt = 1
+        self.not_before = 0.0  # time.monotonic() before which the job must not start
+        self.reserved = False  # holds a token of its host's bucket
+
+
+class DownloadScheduler:
+    def __init__(self, max_workers: int = DOWNLOAD_WORKERS, per_host: int = PER_HOST_LIMIT,
+                 max_pending: Optional[int] = None, collect: bool = True,
+                 retry: Optional[RetryPolicy] = retry_policy, limiter: HostLimiter = host_limiter):
+        """
+        :param max_pending: submit() blocks while this many jobs are waiting, so a producer
+            feeding info dicts in cannot get far ahead of the downloads (default 2 * max_workers)
+        :param collect: keep every job for wait(). A long running caller that waits on the
+            futures submit() returns can turn this off, so finished jobs are not kept around.
+        :param retry: when and how often failed jobs are retried, None never retries
+        :param limiter: token buckets pacing the job starts per host
+        """
+        self.max_workers = max(1, max_workers)
+        self.per_host = max(1, per_host)
+        self.max_pending = max_pending or 2 * self.max_workers
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='download')
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._pending = deque()
+        self._running = defaultdict(int)
+        self._running_total = 0
+        self._jobs = []
+        self._collect = collect
+        self.retry = retry
+        self.limiter = limiter
+        self._wake_at = None
+
+    def submit(self, video_number: int, host: str, fn: Callable, *args) -> Future:
+        """
+        Queue fn(*args). Jobs for a host that is at its limit wait without holding a worker.
+
+        :param video_number: number used in the output file name, also the result order
+        :param host: media host the job downloads from
+        """
+        job = _Job(video_number, host, fn, args)
+        with self._lock:
+            while len(self._pending) >= self.max_pending:
+                self._room.wait()
+            if self._collect:
+                self._jobs.append(job)
+            self._pending.append(job)
+            self._dispatch()
+        return job.future
+
+    def wait(self) -> List[Tuple[int, Optional[BaseException]]]:
+        """
+        Block until every job submitted since the last wait() is done.
+
+        :return: (video_number, exception or None) for each of those jobs, ordered by video number
+        """
+        with self._lock:
+            jobs, self._jobs = self._jobs, []
+        wait([job.future for job in jobs])
+        results = []
+        for job in jobs:
+            error = job.future.exception()
+            later = job.future.result() if error is None else None
+            if isinstance(later, Future):
+                error = later.exception()  # Blocks until the later stage is done
+            results.append((job.video_number, error))
+        return sorted(results, key=lambda r: r[0])
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.wait()
+        self.shutdown()
+
+    def _dispatch(self):
+        # Called with the lock held
+        skipped = deque()
+        now = time.monotonic()
+        while self._pending and self._running_total < self.max_workers:
+            job = self._pending.popleft()
+            if self._running[job.host] >= self.per_host:
+                skipped.append(job)
+                continue
+            if not job.reserved:
+                job.reserved = True
+                wait_for = self.limiter.reserve(job.host)
+                if wait_for > 0:
+                    job.not_before = max(job.not_before, now + wait_for)
+            if job.not_before > now:
+                self._wake(job.not_before - now)
+                skipped.append(job)
+                continue
+            self._running[job.host] += 1
+            self._running_total += 1
+            self._executor.submit(self._run, job)
+        skipped.extend(self._pending)
+        self._pending = skipped
+        self._room.notify_all()
+
+    def _wake(self, delay):
+        # Called with the lock held: dispatch again once the first waiting job may start
+        at = time.monotonic() + delay
+        if self._wake_at is not None and self._wake_at <= at:
+            return
+        self._wake_at = at
+        timer = threading.Timer(delay, self._redispatch)
+        timer.daemon = True
+        timer.start()
+
+    def _redispatch(self):
+        with self._lock:
+            self._wake_at = None
+            self._dispatch()
+
+    def _run(self, job):
+        retry_in = None
+        try:
+            result = job.fn(*job.args)
+            raise_failed(result)
+            job.future.set_result(result)
+        except BaseException as e:
+            retry_in = self.retry.delay(e, job.attempt) if self.retry is not None else None
+            if retry_in is None:
+                job.future.set_exception(e)
+            else:
+                print(f"Video {job.video_number}: retrying in {retry_in:.1f} s after: {e}")
+                metrics.count('ytdl_retries_total')
+                if throttled(e):
+                    self.limiter.pause(job.host, retry_in)
+        finally:
+            with self._lock:
+                self._running[job.host] -= 1
+                self._running_total -= 1
+                if retry_in is not None:
+                    job.attempt += 1
+                    job.reserved = False
+                    job.not_before = time.monotonic() + retry_in
+                    self._pending.append(job)
+                self._dispatch()
+
+
+class MergeStage:
+    """
+    Muxing of downloaded streams, kept off the download workers.
+
+    Each merge runs an ffmpeg process, at most max_workers of them at once. submit()
+    blocks while max_pending merges are already waiting, which holds back the
+    downloads feeding the stage when merging cannot keep up.
+    """
+
+    def __init__(self, max_workers: int = MERGE_WORKERS, max_pending: Optional[int] = None):
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max_pending or 2 * self.max_workers
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='merge')
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_pending)
+
+    def submit(self, fn: Callable, *args) -> Future:
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+def entry_url(entry: Dict) -> str:
+    return entry.get('original_url') or entry.get('webpage_url') or entry['url']
+
+
+def hydrate_videos(entries: Iterable[Tuple[int, Dict]], workers: int = METADATA_WORKERS,
+                   on_error: Optional[Callable[[int, Exception], None]] = None) -> Iterator[Tuple[int, Dict]]:
+    """
+    Fetch full metadata for flat entries, at most `workers` at a time.
+
+    :param entries: (index, flat entry) pairs, consumed lazily
+    :param on_error: called with (index, exception) for an entry that fails, instead of printing it
+    :return: (index, full info) pairs in input order. Entries that fail are reported and skipped.
+    Only a window of 2 * workers infos is held at once, so memory does not grow with the playlist.
+    """
+    def fetch(entry):
+        return extract_info(entry_url(entry), {'quiet': True})
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        entries = iter(entries)
+        while True:
+            for i, entry in entries:
+                window.append((i, executor.submit(fetch, entry)))
+                if len(window) >= 2 * workers:
+                    break
+            if not window:
+                return
+            i, future = window.popleft()
+            try:
+                yield i, future.result()
+            except Exception as te:
+                if on_error is not None:
+                    on_error(i, te)
+                else:
+                    print(f"Error fetching data for video {i}: {te}")
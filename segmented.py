@@ -0,0 +1,255 @@
+"""
+Multi-connection download of a single progressive file.
+
+The file is split by its filesize into byte ranges that are fetched in
+parallel with HTTP Range requests, each one written at its offset in a
+preallocated .part file. A segment that fails with a transient error is
+retried on its own, continuing from the last byte it wrote; the other
+segments carry on. The finished file is renamed into place, where yt-dlp
+then finds it already downloaded.
+
+The .part file is yt-dlp's own, and a download picks up whatever an earlier
+run left there:
+
+- Next to it, a .segments file records how far every segment got. A run that
+  crashed or failed is continued from there, segment by segment.
+- A .part file without one was written front to back by yt-dlp. Its bytes are
+  kept and only the rest of the file is split into segments.
+
+abandon() hands a segmented .part file back to yt-dlp, cut to the bytes
+written without a gap, which yt-dlp then continues from.
+
+bench/segments.py checks all of it against bench/server.py.
+"""
+
+import json
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from retry import RetryPolicy, retry_policy
+
+CONNECTIONS = int(os.environ.get('YTDL_SEGMENTS', 4))
+MIN_SEGMENT = int(os.environ.get('YTDL_MIN_SEGMENT', 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 30
+STATE_SUFFIX = '.segments'  # appended to the .part file name
+
+
+class SegmentError(Exception):
+    """The server does not serve the file the way a segmented download needs."""
+
+
+def split(size: int, connections: int, min_segment: int = MIN_SEGMENT) -> List[Tuple[int, int]]:
+    """
+    :return: inclusive (start, end) byte ranges, at most `connections` of them and none smaller than
+        min_segment (except the only one)
+    """
+    if size <= 0:
+        return []
+    count = max(1, min(connections, size // max(1, min_segment)))
+    step = -(-size // count)
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+def segmentable(fmt: Optional[Dict], connections: int = CONNECTIONS, min_segment: int = MIN_SEGMENT) -> bool:
+    """
+    :param fmt: a format dict of an info dict
+    :return: True for a plain HTTP(S) file of known size worth more than one connection
+    """
+    if not fmt or connections < 2 or fmt.get('fragments'):
+        return False
+    if fmt.get('protocol') not in ('http', 'https') or not fmt.get('url'):
+        return False
+    return (fmt.get('filesize') or 0) >= 2 * min_segment
+
+
+def contiguous(segments: List[List[int]]) -> int:
+    """
+    :param segments: [first byte, next byte to write, last byte] of every segment
+    :return: number of bytes from the start of the file written without a gap
+    """
+    done = 0
+    for start, next_byte, end in sorted(segments):
+        if start > done:
+            break
+        done = max(done, next_byte)
+        if next_byte <= end:
+            break
+    return done
+
+
+def load_state(tmpfilename: str, size: int) -> Optional[List[List[int]]]:
+    """
+    :return: the segments recorded next to tmpfilename, None if there is no usable record
+    """
+    try:
+        with open(tmpfilename + STATE_SUFFIX) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('size') != size or not os.path.exists(tmpfilename) or os.path.getsize(tmpfilename) != size:
+        return None
+    return state['segments']
+
+
+def abandon(filepath: str) -> None:
+    """
+    Leave a .part file of a segmented download to yt-dlp, which continues a .part file from its end.
+    """
+    tmpfilename = filepath + '.part'
+    try:
+        with open(tmpfilename + STATE_SUFFIX) as f:
+            segments = json.load(f)['segments']
+    except (OSError, ValueError, KeyError):
+        return
+    if os.path.exists(tmpfilename):
+        with open(tmpfilename, 'r+b') as f:
+            f.truncate(contiguous(segments))
+    os.remove(tmpfilename + STATE_SUFFIX)
+
+
+class SegmentedDownload:
+    def __init__(self, url: str, size: int, filepath: str, headers: Optional[Dict] = None,
+                 connections: int = CONNECTIONS, min_segment: int = MIN_SEGMENT,
+                 retry: RetryPolicy = retry_policy, progress_hooks: Optional[List[Callable]] = None,
+                 info_dict: Optional[Dict] = None):
+        """
+        :param size: exact size of the file in bytes, checked against the server's Content-Range
+        :param filepath: final path, data goes to filepath + ".part" until every segment is done
+        :param progress_hooks: called with yt-dlp style progress dicts ("downloading", "finished")
+        """
+        self.url = url
+        self.size = size
+        self.filepath = filepath
+        self.tmpfilename = filepath + '.part'
+        self.statefile = self.tmpfilename + STATE_SUFFIX
+        self.headers = dict(headers or {})
+        self.connections = connections
+        self.min_segment = min_segment
+        self.segments = []  # [first byte, next byte to write, last byte]
+        self.retry = retry
+        self.progress_hooks = list(progress_hooks or [])
+        self.info_dict = info_dict or {}
+        self.downloaded = 0
+        self._lock = threading.Lock()
+        self._saving = threading.Lock()
+        self._started = None
+        self._reported = 0.0
+
+    def run(self) -> str:
+        """
+        :return: filepath
+        :raises SegmentError: when the server ignores Range or serves a different size. The .part file
+            and its segment state are kept on any failure, the next run continues them.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+        self.segments = self._plan()
+        with open(self.tmpfilename, 'ab') as f:
+            f.truncate(self.size)  # Preallocated, every segment writes at its own offset
+        self.downloaded = sum(next_byte - start for start, next_byte, _ in self.segments)
+        self._save_state()
+        self._started = time.monotonic()
+        missing = [segment for segment in self.segments if segment[1] <= segment[2]]
+        try:
+            if missing:
+                with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix='segment') as executor:
+                    for future in [executor.submit(self._fetch_segment, segment) for segment in missing]:
+                        future.result()
+        finally:
+            self._save_state()
+        os.replace(self.tmpfilename, self.filepath)
+        os.remove(self.statefile)
+        self._report('finished')
+        return self.filepath
+
+    def _plan(self):
+        segments = load_state(self.tmpfilename, self.size)
+        if segments is not None:
+            return segments
+        # Written front to back by yt-dlp (or nothing yet): keep those bytes, split up the rest
+        done = os.path.getsize(self.tmpfilename) if os.path.exists(self.tmpfilename) else 0
+        if done > self.size:
+            done = 0
+            os.remove(self.tmpfilename)
+        segments = [[0, done, done - 1]] if done else []
+        for start, end in split(self.size - done, self.connections, self.min_segment):
+            segments.append([done + start, done + start, done + end])
+        return segments
+
+    def _save_state(self):
+        # Written next to the state it replaces and renamed over it, never left half written
+        with self._saving:
+            with open(self.statefile + '.tmp', 'w') as f:
+                json.dump({'size': self.size, 'segments': self.segments}, f)
+            os.replace(self.statefile + '.tmp', self.statefile)
+
+    def _fetch_segment(self, segment):
+        end = segment[2]
+        attempt = 1
+        while segment[1] <= end:
+            try:
+                self._read_range(segment)
+            except SegmentError:
+                raise
+            except Exception as e:
+                delay = self.retry.delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    def _read_range(self, segment):
+        """
+        Write the rest of segment, advancing segment[1] past every byte written so a retry continues there.
+        """
+        _, start, end = segment
+        request = urllib.request.Request(self.url, headers=dict(self.headers, Range=f"bytes={start}-{end}"))
+        # Unbuffered, the segment state never counts a byte that is not in the file yet
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response, \
+                open(self.tmpfilename, 'r+b', buffering=0) as f:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status != 206 or not content_range.startswith(f"bytes {start}-"):
+                raise SegmentError(f"Range not supported: HTTP {response.status} {content_range}")
+            if not content_range.endswith(f"/{self.size}"):
+                raise SegmentError(f"Size mismatch: {content_range}, expected {self.size} bytes")
+            f.seek(start)
+            while segment[1] <= end:
+                chunk = response.read(min(CHUNK_SIZE, end + 1 - segment[1]))
+                if not chunk:
+                    raise ConnectionError(f"Connection closed at byte {segment[1]} of segment {start}-{end}")
+                f.write(chunk)
+                segment[1] += len(chunk)
+                self._advance(len(chunk))
+
+    def _advance(self, count):
+        with self._lock:
+            self.downloaded += count
+            now = time.monotonic()
+            if now - self._reported < 0.2:
+                return
+            self._reported = now
+        self._save_state()  # A crashed run loses at most the bytes of the last 0.2 s
+        self._report('downloading')
+
+    def _report(self, status):
+        elapsed = time.monotonic() - self._started
+        with self._lock:
+            downloaded = self.downloaded
+        speed = downloaded / elapsed if elapsed > 0 else None
+        d = {
+            'status': status,
+            'downloaded_bytes': downloaded,
+            'total_bytes': self.size,
+            'filename': self.filepath,
+            'tmpfilename': self.tmpfilename,
+            'elapsed': elapsed,
+            'speed': speed,
+            'eta': (self.size - downloaded) / speed if speed else None,
+            'info_dict': self.info_dict,
+        }
+        for hook in self.progress_hooks:
+            hook(d)
@@ -0,0 +1,63 @@
+"""
+Playlist index selection such as "1,2,3-7,12".
+
+The parsed selection can be handed to yt-dlp as its playlist_items option,
+so extraction only fetches the selected entries and never touches the rest.
+"""
+
+from typing import Dict, Iterator, List, Tuple
+
+
+class Selection:
+    def __init__(self, ranges: List[Tuple[int, int]]):
+        """
+        :param ranges: inclusive (start, end) pairs of 1-based playlist indices, in the order given
+        """
+        self.ranges = ranges
+
+    @classmethod
+    def parse(cls, text: str) -> 'Selection':
+        """
+        :raises ValueError: on anything that is not a comma separated list of numbers and ranges
+        """
+        ranges = []
+        for part in text.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+            if start < 1 or end < start:
+                raise ValueError(f"Invalid range: {part}")
+            ranges.append((start, end))
+        return cls(ranges)
+
+    def __bool__(self) -> bool:
+        return bool(self.ranges)
+
+    def __contains__(self, index: int) -> bool:
+        return any(start <= index <= end for start, end in self.ranges)
+
+    def indices(self) -> Iterator[int]:
+        for start, end in self.ranges:
+            yield from range(start, end + 1)
+
+    def to_playlist_items(self) -> str:
+        """
+        :return: the selection in yt-dlp's playlist_items syntax
+        """
+        return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in self.ranges)
+
+    def options(self, options: Dict) -> Dict:
+        """
+        :return: a copy of the YoutubeDL options restricted to this selection
+        """
+        options = dict(options)
+        if self.ranges:
+            options['playlist_items'] = self.to_playlist_items()
+        return options
+
+    def __str__(self) -> str:
+        return ','.join(str(start) if start == end else f"{start}-{end}" for start, end in self.ranges)
@@ -0,0 +1,189 @@
+"""
+Staged output with disk space admission.
+
+A download is admitted only once its projected size fits on the disk of its
+output directory, next to everything already admitted there and a MIN_FREE
+margin. Until then it waits; a download that could not fit even on an idle
+disk fails right away with InsufficientSpace instead of filling the disk
+halfway through a merge.
+
+The reservations live in the Coordinator, per device, so every process that
+writes to the same disk (e.g. the web workers) admits against the same space.
+A running download reports what it has written, which then only counts as
+used space on the disk, not also as reserved.
+
+Admitted downloads write into a staging directory inside their output
+directory (so on the same filesystem), and finished files are published with
+an atomic rename. The output directory only ever holds complete files, the
+staging directory is removed once it is empty. The staged names follow the
+output names, so a download restarted after a crash continues its .part files.
+"""
+
+import errno
+import os
+import shutil
+import threading
+import time
+from typing import Dict, Optional
+
+import metrics
+from coordination import Coordinator, coordinator as default_coordinator, worker_id
+
+STAGING_DIR = '.ytdl_staging'
+MIN_FREE = int(os.environ.get('YTDL_MIN_FREE_BYTES', 256 * 1024 * 1024))
+ADMISSION_TIMEOUT = float(os.environ.get('YTDL_ADMISSION_TIMEOUT', 60 * 60))
+POLL_INTERVAL = 1.0  # space released by another process is noticed this late
+
+
+class InsufficientSpace(OSError):
+    def __init__(self, directory: str, needed: int, free: int):
+        super().__init__(errno.ENOSPC, f"Not enough space in {directory or '.'}: "
+                                       f"{needed} bytes needed, {max(0, free)} bytes available")
+
+
+def _size(fmt: Dict, duration: Optional[float]) -> int:
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return int(size or 0)
+
+
+def estimate_size(info: Dict, format_spec: Optional[str]) -> int:
+    """
+    :return: bytes a download of format_spec is expected to take at its peak, 0 if unknown.
+        A merge holds the streams and the merged file at once, so it counts twice.
+    """
+    formats = info.get('formats') or [info]
+    duration = info.get('duration')
+    parts = (format_spec or 'best').split('+')
+    total = 0
+    for part in parts:
+        fmt = next((f for f in formats if f.get('format_id') == part), None)
+        if fmt is not None:
+            total += _size(fmt, duration)
+            continue
+        # "bestaudio", "best", ...: the largest format that could be picked is a safe upper bound
+        audio = part in ('ba', 'bestaudio') or part.startswith(('ba[', 'bestaudio['))
+        candidates = [f for f in formats if not audio or f.get('vcodec') == 'none'] or formats
+        total += max((_size(f, duration) for f in candidates), default=0)
+    return total * 2 if len(parts) > 1 else total
+
+
+class StagedOutput:
+    """
+    One admitted download: its staged options, and the space reserved for it until it is published.
+    """
+
+    def __init__(self, sink: 'OutputSink', ydl_opts: Dict):
+        self.sink = sink
+        self.reservation = None  # ID of the reservation in the Coordinator
+        self.final_dir = None
+        self.staging_dir = None
+        self._written = {}  # file -> bytes written to it
+        self._reported = 0.0
+        self._lock = threading.Lock()  # segmented downloads report from several threads
+        ydl_opts = dict(ydl_opts, progress_hooks=list(ydl_opts.get('progress_hooks', [])) + [self._progress])
+        self.options = ydl_opts
+        outtmpl = ydl_opts.get('outtmpl') or '%(title)s [%(id)s].%(ext)s'
+        directory, name = os.path.split(outtmpl) if isinstance(outtmpl, str) else ('%', None)
+        # A template that picks its own directories is written in place
+        if '%' not in directory:
+            self.final_dir = directory
+            self.staging_dir = os.path.join(directory, STAGING_DIR)
+            self.options = dict(ydl_opts, outtmpl=os.path.join(self.staging_dir, name))
+
+    def _progress(self, d: Dict) -> None:
+        if d['status'] != 'downloading' or self.reservation is None:
+            return
+        with self._lock:
+            self._written[d.get('tmpfilename') or d.get('filename')] = d.get('downloaded_bytes') or 0
+            now = time.monotonic()
+            if now - self._reported < POLL_INTERVAL:
+                return
+            self._reported = now
+            written = sum(self._written.values())
+        self.sink.coordinator.report_written(self.reservation, written)
+
+    def publish(self, future) -> Dict:
+        """
+        Move the finished files out of staging and release the reservation.
+
+        :param future: Future of the processed info dict of the staged download
+        :return: the info dict with the published paths
+        """
+        try:
+            result = future.result()
+            if self.staging_dir is None:
+                return result
+            downloads = []
+            for download in result.get('requested_downloads') or []:
+                filepath = download.get('filepath')
+                staged = filepath and os.path.dirname(os.path.abspath(filepath)) == os.path.abspath(self.staging_dir)
+                if staged and os.path.exists(filepath):
+                    published = os.path.join(self.final_dir, os.path.basename(filepath))
+                    os.replace(filepath, published)
+                    download = dict(download, filepath=published)
+                downloads.append(download)
+            result = dict(result, requested_downloads=downloads)
+            if downloads and result.get('filepath'):
+                result['filepath'] = downloads[0]['filepath']
+            try:
+                os.rmdir(self.staging_dir)
+            except OSError:
+                pass  # Another download still uses it
+            return result
+        finally:
+            self.sink.release(self)
+
+
+class OutputSink:
+    def __init__(self, min_free: int = MIN_FREE, timeout: float = ADMISSION_TIMEOUT,
+                 coordinator: Coordinator = default_coordinator):
+        """
+        :param min_free: bytes every disk keeps free on top of the admitted downloads
+        :param timeout: longest wait for space before a download fails
+        :param coordinator: keeps the reservations of every process
+        """
+        self.min_free = min_free
+        self.timeout = timeout
+        self.coordinator = coordinator
+        self._room = threading.Condition()  # notified when this process releases space
+
+    def admit(self, info: Dict, ydl_opts: Dict) -> StagedOutput:
+        """
+        Wait until the download fits, then reserve its space.
+
+        :raises InsufficientSpace: it does not fit even with nothing else admitted, or not within timeout
+        """
+        staged = StagedOutput(self, ydl_opts)
+        needed = estimate_size(info, ydl_opts.get('format'))
+        directory = staged.staging_dir or '.'
+        os.makedirs(directory, exist_ok=True)
+        device = str(os.stat(directory).st_dev)
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._room:
+            while True:
+                free = shutil.disk_usage(directory).free
+                reservation, reserved = self.coordinator.reserve(device, needed, free - self.min_free, worker_id())
+                if reservation is not None:
+                    staged.reservation = reservation
+                    return staged
+                remaining = deadline - time.monotonic()
+                if not reserved or remaining <= 0:
+                    raise InsufficientSpace(directory, needed, free - reserved - self.min_free)
+                if not waited:
+                    waited = True
+                    metrics.count('ytdl_admission_waits_total')
+                # Woken by a release here, or to look again for releases elsewhere and at the disk itself
+                self._room.wait(min(remaining, POLL_INTERVAL))
+
+    def release(self, staged: StagedOutput) -> None:
+        with self._room:
+            if staged.reservation is not None:
+                self.coordinator.release(staged.reservation)
+                staged.reservation = None
+            self._room.notify_all()
+
+
+output_sink = OutputSink()
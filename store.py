@@ -0,0 +1,149 @@
+"""
+Content-addressed media store.
+
+Every downloaded file is kept once, under the video it came from and the
+format it was downloaded with:
+
+    <store>/<extractor>-<video id>/<format>.<ext>
+
+A later download of the same video and format, from another playlist or
+another user, gets a hardlink to the stored file instead of a new transfer.
+
+Stored files are only ever hardlinks of downloaded files, so the store takes
+no space of its own, and it is only used for downloads on its filesystem
+(YTDL_STORE_DIR). Once every download linked to a stored file is deleted, the
+store holds its last link, and prune() removes it.
+"""
+
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Dict, Optional
+
+STORE_DIR = os.environ.get(
+    'YTDL_STORE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'ytdl_store')
+)
+PRUNE_INTERVAL = float(os.environ.get('YTDL_STORE_PRUNE_INTERVAL', 10 * 60))
+
+_UNSAFE = re.compile(r'[^\w.+-]')
+
+
+def store_key(info: Dict, ydl_opts: Dict) -> Optional[str]:
+    """
+    :return: "<extractor>-<video id>/<format>", None if the info dict has no video ID
+    """
+    if not info.get('id'):
+        return None
+    video = f"{info.get('extractor_key') or 'generic'}-{info['id']}"
+    fmt = ydl_opts.get('format') or 'default'
+    if ydl_opts.get('merge_output_format'):
+        fmt += '_' + ydl_opts['merge_output_format']
+    return f"{_UNSAFE.sub('_', video)}/{_UNSAFE.sub('_', fmt)}"
+
+
+def link(src: str, dest: str, copy: bool = True) -> bool:
+    """
+    Hardlink src to dest, replacing dest; copy when the two are on different filesystems.
+
+    :param copy: False to leave dest alone instead of copying
+    :return: False if dest was left alone
+    """
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return True
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    tmp = dest + '.link'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        if not copy:
+            return False
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+    return True
+
+
+class MediaStore:
+    def __init__(self, root: str = STORE_DIR, prune_interval: float = PRUNE_INTERVAL):
+        """
+        :param prune_interval: seconds between two prune() runs started by put()
+        """
+        self.root = root
+        self.prune_interval = prune_interval
+        self._pruned = time.monotonic()
+        self._pruning = threading.Lock()
+
+    def links_with(self, directory: str) -> bool:
+        """
+        :return: whether files in directory can be stored, i.e. it is on the store's filesystem
+        """
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            return os.stat(self.root).st_dev == os.stat(directory).st_dev
+        except OSError:
+            return False
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :return: path of the stored file for key, None if it is not stored
+        """
+        directory, name = os.path.split(os.path.join(self.root, key))
+        try:
+            candidates = os.listdir(directory)
+        except FileNotFoundError:
+            return None
+        for candidate in candidates:
+            stem, ext = os.path.splitext(candidate)
+            if stem == name and ext not in ('.link', '.part'):
+                return os.path.join(directory, candidate)
+        return None
+
+    def put(self, key: str, filepath: str) -> str:
+        """
+        Keep a finished download in the store, as a hardlink.
+
+        :return: path of the stored file, None if it could not be linked
+        """
+        if time.monotonic() - self._pruned > self.prune_interval:
+            self.prune()
+        ext = os.path.splitext(filepath)[1]
+        stored = os.path.join(self.root, key) + ext
+        return stored if link(filepath, stored, copy=False) else None
+
+    def prune(self) -> int:
+        """
+        Remove the stored files no download links to any more.
+
+        :return: number of files removed
+        """
+        if not self._pruning.acquire(blocking=False):
+            return 0  # Another thread is at it
+        removed = 0
+        try:
+            self._pruned = time.monotonic()
+            for directory, _, names in os.walk(self.root, topdown=False):
+                for name in names:
+                    if name.endswith(('.link', '.part')):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        if os.stat(path).st_nlink == 1:
+                            os.remove(path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+                if directory != self.root:
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        pass  # Still holds files
+        finally:
+            self._pruning.release()
+        return removed
+
+
+media_store = MediaStore()
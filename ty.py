@@ -1,9 +1,17 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Dict
-import yt_dlp
+from concurrent.futures import Future
+from typing import List, Dict, Union, Optional
 import re
 import os
 import sys
+from urllib.parse import urlparse
+
+import metrics
+from cache import extract_info, canonical_id
+from download import start_download
+from formats import FormatIndex, CoverageMatrix, OFFERED_HEIGHTS
+from scheduler import DownloadScheduler, entry_url, hydrate_videos
+from selection import Selection
+from manifest import Manifest
 
 
 class Data:
@@ -42,8 +50,8 @@ class Get:
     def __init__(self):
         self.url = ''
 
-    def set_url(self)-> None:
-        self.url = input("Enter URL: ")
+    def set_url(self, url: Optional[str] = None)-> None:
+        self.url = url or input("Enter URL: ")
 
     @staticmethod
     def is_playlist(info: Dict):
@@ -51,13 +59,18 @@ class Get:
             return True
         return False
 
-    def extract_info(self) -> Data:
+    def extract_info(self, selection: Optional[Selection] = None) -> Data:
+        """
+        :param selection: when known up front, only these playlist entries are extracted
+        """
         options = {
-            'quiet': True
+            'quiet': True,
+            'extract_flat': 'in_playlist'  # Playlist entries stay flat until they are selected
         }
+        if selection:
+            options = selection.options(options)
         try:
-            with yt_dlp.YoutubeDL(options) as ydl:
-                info = ydl.extract_info(self.url, download=False)
+            info = extract_info(self.url, options)
 
             data = Data()
             data.set_url(self.url)
@@ -76,8 +89,7 @@ def extract_video_info(url: str) -> Dict:
         'quiet': True
     }
     try:
-        with yt_dlp.YoutubeDL(options) as ydl:
-            info = ydl.extract_info(url, download=False)
+        info = extract_info(url, options)
     except Exception as invalid_url:
         print(f"Invalid Url: {invalid_url}")
         sys.exit(0)
@@ -85,18 +97,16 @@ def extract_video_info(url: str) -> Dict:
     return info
 
 
-def get_formats(info: Dict) -> List:
+def get_formats(info: Union[Dict, FormatIndex]) -> List:
+    """
+    :param info: info dict or its already built FormatIndex
+    :return: FormatRecords of the mp4 formats at the offered resolutions
+    """
     print("\nAvailable formats:")
-    filtered_formats = []
-    for i in range(len(info["formats"])):
-        if 'ext' in info["formats"][i].keys() and info["formats"][i].get('ext') == 'mp4':
-            if info["formats"][i].get('height') in [1440, 2160,1080, 720, 480] or info['formats'][i].get('quality') in ['360', '720', '1080']:
-                filtered_formats.append(info["formats"][i])
-                f_id = info["formats"][i].get('format_id')
-                resolution = info["formats"][i].get('resolution')
-                file_size = info["formats"][i].get('filesize')  # in bytes
-                size_in_mb = f"{file_size / (1024 * 1024):.2f} MB" if file_size else "Unknown size"
-                print(f"{f_id}: {resolution}, {size_in_mb}")
+    index = info if isinstance(info, FormatIndex) else FormatIndex.from_info(info)
+    filtered_formats = index.select(OFFERED_HEIGHTS, ext='mp4')
+    for fmt in filtered_formats:
+        print(fmt.describe())
 
     return filtered_formats
 
@@ -109,8 +119,7 @@ def check_format_availability(url: str, frmt_id: str) -> bool:
     ydl_opts = {
         'quiet': True,
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    info = extract_info(url, ydl_opts)
     return frmt_id in [fmt['format_id'] for fmt in info['formats']]
 
 
@@ -132,42 +141,34 @@ def check_format_availability(url: str, frmt_id: str) -> bool:
 def list_playlist_videos(info: Dict) -> Dict:
     """
 
-    :param info: Dict
+    :param info: Dict, flat playlist info
     :return :
 
-    return type is a dictionary with keys as index and values is another dictionary
+    return type is a dictionary with keys as index and values is the flat playlist entry
+    (id, url and title only). Full metadata is fetched later by hydrate_videos.
     """
-
-    def extract_video_data(i, entry):
-        return i, extract_video_info(entry['original_url'])
-
     print("\nPlaylist contents:")
     video_data = {}
-
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        for i, entry in enumerate(info['entries'], start=1):
-            print(f"{i}. {entry['title']}")
-            print(f"Thread {i} started")
-            futures.append(executor.submit(extract_video_data, i, entry))
-        
-        for future in as_completed(futures):
-            try:
-                i, data = future.result()
-                print(f"Thread {i} Ended.")
-                video_data[i] = data
-            except Exception as te:
-                print(f"Error fetching data for video {i}: {te}")
+    # With a selection pushed into extraction the entries are a subset, yt-dlp lists their real indices
+    indices = info.get('requested_entries') or range(1, len(info['entries']) + 1)
+    for i, entry in zip(indices, info['entries']):
+        print(f"{i}. {entry['title']}")
+        video_data[i] = entry
 
     return video_data
 
-def download_video(url: str, format_idx, save_dir, video_number, title) -> None:
+
+def download_video(video: Union[Dict, str], format_idx, save_dir, video_number, title,
+                   manifest: Optional[Manifest] = None) -> Future:
     """
-    :type url: str
+    :type video: Dict or str, an info dict is downloaded without extracting it again, a URL is
+        looked up in the metadata cache first
     :type format_idx: str
     :type save_dir: str
     :type video_number: int
     :type title: str
+    :type manifest: Manifest, journals the video's progress when given
+    :return: Future of the download, done once its streams are merged
     """
     sanitized_title = sanitize_filename(title)
     ydl_opts = {
@@ -177,8 +178,11 @@ def download_video(url: str, format_idx, save_dir, video_number, title) -> None:
         'outtmpl': os.path.join(save_dir, f"{video_number:02d}_{sanitized_title}.%(ext)s")
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+    if not isinstance(video, dict):
+        video = extract_info(video, {'quiet': True})
+    if manifest is not None:
+        return manifest.start_download(video_number, video, ydl_opts)
+    return start_download(video, ydl_opts)
 
 
 def get_videos_to_download(folder: bool) -> List:
@@ -187,41 +191,90 @@ def get_videos_to_download(folder: bool) -> List:
     videos_to_download = []
     try:
         videos = input("Enter index of video download. \nEnter comma separated values and range. \nEg: 1,2,3-7,12\n")
-        for i in videos.split(','):
-            if '-' in i:
-                start, end = map(int, i.split('-'))
-                videos_to_download.extend(range(start, end + 1))
-            elif not i:
-                continue
-            else:
-                videos_to_download.append(int(i.strip()))
+        videos_to_download = list(Selection.parse(videos).indices())
     except Exception as e:
         print(f"Exception in retrieving videos.\n{e}")
     finally:
         return videos_to_download
 
-def main():
+def report_failures(results: List) -> None:
+    for video_number, error in results:
+        if error is not None:
+            print(f"Download {video_number} failed: {error}")
+
+
+def run_downloads(videos: List[Dict], save_dir: str, manifest: Manifest) -> None:
+    """
+    :param videos: dicts with number, url, title, format_id and optionally the media host
+    """
+    scheduler = DownloadScheduler()
+    for video in videos:
+        print(f"Downloading {video['title']} in format {video['format_id']}...")
+        host = video.get('host') or urlparse(video['url']).netloc
+        scheduler.submit(video['number'], host, download_video, video['url'], video['format_id'],
+                         save_dir, video['number'], video['title'], manifest)
+
+    report_failures(scheduler.wait())
+    scheduler.shutdown()
+    print(metrics.summary())
+
+
+def main(url: Optional[str] = None, selection: Optional[str] = None):
+    """
+    :param url: asked for when not given
+    :param selection: playlist indices such as "1,2,3-7,12". When given, only these entries are
+    extracted and the selection prompt is skipped.
+    """
+    selection = Selection.parse(selection) if selection else None
 
     g = Get()
-    g.set_url()
-    data_object = g.extract_info()
+    g.set_url(url)
+
+    # A previous run of the same URL that did not finish is resumed from its journal,
+    # finished videos are skipped and unfinished ones continue their .part files
+    manifest = Manifest(os.getcwd(), canonical_id(g.url))
+    unfinished = manifest.unfinished()
+    if unfinished:
+        resume = input(
+            f"Resume the unfinished download of this URL ({len(unfinished)} videos left)? (yes/no): ").strip().lower() == 'yes'
+        if resume:
+            run_downloads(unfinished, os.getcwd(), manifest)
+            return
+
+    data_object = g.extract_info(selection)
 
     if data_object.playlist:
         data_object.videos = list_playlist_videos(data_object.get_info())
+        if selection:
+            to_download = list(selection.indices())
+        else:
+            to_download = get_videos_to_download(data_object.playlist)
+        # Only the selected entries are hydrated, one window at a time
+        hydrated = hydrate_videos((i, data_object.videos[i]) for i in to_download if i in data_object.videos)
     else:
-        temp = data_object.info
-        temp['url'] = data_object.info.get('original_url')
-        data_object.videos = [temp]
-        del temp
+        data_object.videos = [data_object.info]
+        hydrated = iter([(0, data_object.info)])
+
+    # Single pass over the selected videos keeping only their compact format index.
+    # The info dicts stay in the metadata cache until each download starts.
+    videos = {}
+    indexes = {}
+    for idx, (_, info) in enumerate(hydrated, start=1):
+        videos[idx] = (entry_url(info), info['title'])
+        with metrics.timer('format_selection'):
+            indexes[idx] = FormatIndex.from_info(info)
+    if not videos:
+        print("No videos selected.")
+        sys.exit(0)
 
-    to_download = get_videos_to_download(data_object.playlist)
-    selected_videos = [data_object.videos[i] for i in to_download]
+    with metrics.timer('format_selection'):
+        matrix = CoverageMatrix(indexes)
+    suggested = matrix.suggest(OFFERED_HEIGHTS, ext='mp4')
     print("\nSelect a resolution for video:")
-
-    formats = get_formats(selected_videos[0])
-
-    if formats:
-        format_id = input("Enter the format ID you wish to download: ")
+    if suggested:
+        for line in matrix.describe(OFFERED_HEIGHTS, ext='mp4'):
+            print(line)
+        format_id = input(f"Enter the format ID you wish to download [{suggested}]: ").strip() or suggested
         try:
             int(format_id)
         except ValueError as v:
@@ -231,36 +284,21 @@ def main():
         print("No suitable formats found.")
         sys.exit(0)
 
-    skipped_videos = []
-    for idx, video_url in enumerate(selected_videos, start=1):
-        video_title = data_object.videos[idx-1]['title']
-        print(f"\nChecking format availability for {video_title}...")
-
-        # Check if the selected format is available for the video
-        if check_format_availability(video_url.get('original_url'), format_id):
-            print(f"Downloading {video_title} in format {format_id}...")
-            download_video(video_url.get('original_url'), format_id, os.getcwd(), idx, video_title)
-        else:
-            print(f"Skipped {video_title}: Requested format {format_id} is not available.")
-            skipped_videos.append((video_url, video_title, idx))  # Store skipped videos
-
-    if skipped_videos:
-        print("\nSome videos were skipped due to unavailable format.")
-        retry = input(
-            "Would you like to choose a new format for the skipped videos? (yes/no): ").strip().lower() == 'yes'
-        if retry:
-            for video_url, video_title, idx in skipped_videos:
-                print(f"\nAvailable formats for {video_title}:")
-                formats = get_formats(video_url)
-                if formats:
-                    new_format_id = input(f"Enter the format ID for {video_title}: ")
-                    if check_format_availability(video_url.get('original_url'), new_format_id):
-                        print(f"Retrying download for {video_title} with format {new_format_id}...")
-                        download_video(video_url, new_format_id, os.getcwd(), idx, video_title)
-                    else:
-                        print(f"Format {new_format_id} is still not available for {video_title}. Skipping.")
-                else:
-                    print(f"No available formats for {video_title}.")
+    # Videos without the chosen format fall back to their closest format, no re-extraction needed
+    to_run = []
+    for idx, chosen in matrix.resolve(format_id).items():
+        video_url, video_title = videos[idx]
+        if chosen is None:
+            print(f"Skipped {video_title}: no video formats available.")
+            continue
+        if chosen != format_id:
+            print(f"{video_title}: format {format_id} is not available, using {chosen} instead.")
+        to_run.append({'number': idx, 'url': video_url, 'title': video_title, 'format_id': chosen,
+                       'host': indexes[idx].get(chosen).host})
+
+    manifest.start(to_run)
+    run_downloads(to_run, os.getcwd(), manifest)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python ty.py [URL [SELECTION]]
+    main(*sys.argv[1:3])
\ No newline at end of file
@@ -1,6 +1,16 @@
-import yt_dlp
+import argparse
 import os
 import re
+import sys
+from urllib.parse import urlparse
+
+import metrics
+from archive import Archive, video_key
+from cache import extract_info, canonical_id
+from download import start_download
+from formats import FormatIndex, CoverageMatrix
+from scheduler import DownloadScheduler, hydrate_videos
+from manifest import Manifest
 
 
 def sanitize_filename(name):
@@ -8,26 +18,21 @@ def sanitize_filename(name):
     return re.sub(r'[<>:"/\\|?*]', '_', name)
 
 
+OFFERED_HEIGHTS = [480, 720, 1080]
+
+
 def list_formats(url):
     ydl_opts = {
         'quiet': True,
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    info = extract_info(url, ydl_opts)
 
     print("\nAvailable formats (480p, 720p, 1080p):")
-    filtered_formats = [
-        fmt for fmt in info['formats']
-        if fmt.get('height') in [480, 720, 1080]  # Only 480p, 720p, or 1080p
-    ]
+    filtered_formats = FormatIndex.from_info(info).select(OFFERED_HEIGHTS)  # Only 480p, 720p, or 1080p
 
     for fmt in filtered_formats:
-        format_id = fmt.get('format_id')
-        resolution = fmt.get('resolution')
-        file_size = fmt.get('filesize')  # in bytes
-        size_in_mb = f"{file_size / (1024 * 1024):.2f} MB" if file_size else "Unknown size"
-        print(f"{format_id}: {resolution}, {size_in_mb}")
+        print(fmt.describe())
 
     return filtered_formats
 
@@ -36,9 +41,8 @@ def check_format_availability(url, format_id):
     ydl_opts = {
         'quiet': True,
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        formats = [fmt['format_id'] for fmt in info['formats']]
+    info = extract_info(url, ydl_opts)
+    formats = [fmt['format_id'] for fmt in info['formats']]
     return format_id in formats
 
 
@@ -47,8 +51,7 @@ def list_playlist_videos(url):
         'quiet': True,
         'extract_flat': True  # Only list videos without downloading
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    info = extract_info(url, ydl_opts)
 
     if 'entries' in info:
         print("\nPlaylist contents:")
@@ -60,7 +63,8 @@ def list_playlist_videos(url):
     return info.get('entries', []), info.get('title', 'Playlist')
 
 
-def download_video(url, format_id, save_dir, idx, title):
+def download_video(video, format_id, save_dir, idx, title, manifest=None):
+    # video is either an info dict we already extracted or a URL looked up in the metadata cache
     # Sanitize title for filename
     sanitized_title = sanitize_filename(title)
     ydl_opts = {
@@ -70,14 +74,22 @@ def download_video(url, format_id, save_dir, idx, title):
         'outtmpl': os.path.join(save_dir, f"{idx:02d}_{sanitized_title}.%(ext)s")  # Add index before sanitized title
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+    if not isinstance(video, dict):
+        video = extract_info(video, {'quiet': True})
+    # Returns once the streams are fetched, the merge finishes on the merge stage
+    if manifest is not None:
+        return manifest.start_download(idx, video, ydl_opts)  # Journal the progress so a crashed run can resume
+    return start_download(video, ydl_opts)
+
+
+# Downloads go to HOME/yt_dlp_Downloads, HOME defaults to the current directory
+HOME = os.environ.get('YTDL_HOME')
 
 
 class Download:
-    def __init__(self):
-        self.down_dir = "yt_dlp_Downloads"
-        self.home = "E:\\"
+    def __init__(self, home=None, down_dir="yt_dlp_Downloads"):
+        self.down_dir = down_dir
+        self.home = home or HOME or os.getcwd()
         self.move_to_home()
 
     def move_to_home(self):
@@ -96,58 +108,165 @@ class Download:
         if not os.path.exists(playlist_dir):
             os.mkdir(playlist_dir)
 
+        # Resume an unfinished earlier run from its journal: done videos are skipped,
+        # unfinished ones continue their .part files
+        manifest = Manifest(playlist_dir, canonical_id(url))
+        archive = Archive(playlist_dir)
+        unfinished = manifest.unfinished()
+        if unfinished:
+            resume = input(
+                f"Resume the unfinished download ({len(unfinished)} videos left)? (yes/no): ").strip().lower() == 'yes'
+            if resume:
+                self.run_downloads(unfinished, playlist_dir, manifest, archive)
+                return
+
         # Step 2: Choose download option - all videos or specific ones
         download_all = input("Do you want to download all videos in the playlist? (yes/no): ").strip().lower() == 'yes'
         if download_all:
-            selected_videos = [video['url'] for video in playlist_videos]
+            positions = list(range(1, len(playlist_videos) + 1))
         else:
             video_indices = input("\nEnter video numbers to download (comma-separated, e.g., 1,3,5): ")
-            selected_videos = [playlist_videos[int(i) - 1]['url'] for i in video_indices.split(",") if i.isdigit()]
+            positions = [int(i) for i in video_indices.split(",") if i.isdigit()]
+        selected_videos = [playlist_videos[position - 1] for position in positions]
 
-        # Step 3: Choose the format for all videos
+        # Step 3: One pass over the selected videos builds a coverage matrix of their formats.
+        # Only the compact format indexes are kept, the info dicts stay in the metadata cache.
+        indexes = {}
+        for idx, video in enumerate(selected_videos, start=1):
+            info = extract_info(video['url'], {'quiet': True})
+            with metrics.timer('format_selection'):
+                indexes[idx] = FormatIndex.from_info(info)
+        with metrics.timer('format_selection'):
+            matrix = CoverageMatrix(indexes)
+
+        # Step 4: Choose the format for all videos, the one found in the most videos is suggested
         print("\nSelect a resolution for all videos:")
-        formats = list_formats(selected_videos[0])
-        if formats:
-            format_id = input("Enter the format ID you wish to download: ")
+        suggested = matrix.suggest(OFFERED_HEIGHTS)
+        if suggested:
+            for line in matrix.describe(OFFERED_HEIGHTS):
+                print(line)
+            format_id = input(f"Enter the format ID you wish to download [{suggested}]: ").strip() or suggested
         else:
             print("No suitable formats found.")
             return
 
-        # Step 4: Download each video in the selected format and save with numbered index
-        skipped_videos = []
-        for idx, video_url in enumerate(selected_videos, start=1):
-            video_title = playlist_videos[idx - 1]['title']
-            print(f"\nChecking format availability for {video_title}...")
-
-            # Check if the selected format is available for the video
-            if check_format_availability(video_url, format_id):
-                print(f"Downloading {video_title} in format {format_id}...")
-                download_video(video_url, format_id, playlist_dir, idx, video_title)
-            else:
-                print(f"Skipped {video_title}: Requested format {format_id} is not available.")
-                skipped_videos.append((video_url, video_title, idx))  # Store skipped videos
-
-        # Step 5: Retry download for skipped videos with new format selection
-        if skipped_videos:
-            print("\nSome videos were skipped due to unavailable format.")
-            retry = input(
-                "Would you like to choose a new format for the skipped videos? (yes/no): ").strip().lower() == 'yes'
-            if retry:
-                for video_url, video_title, idx in skipped_videos:
-                    print(f"\nAvailable formats for {video_title}:")
-                    formats = list_formats(video_url)
-                    if formats:
-                        new_format_id = input(f"Enter the format ID for {video_title}: ")
-                        if check_format_availability(video_url, new_format_id):
-                            print(f"Retrying download for {video_title} with format {new_format_id}...")
-                            download_video(video_url, new_format_id, playlist_dir, idx, video_title)
-                        else:
-                            print(f"Format {new_format_id} is still not available for {video_title}. Skipping.")
-                    else:
-                        print(f"No available formats for {video_title}.")
+        # Step 5: Download each video in the selected format, or its closest format when missing,
+        # and save with numbered index. The number is fixed here, so concurrent downloads keep the same file names.
+        videos = dict(enumerate(zip(positions, selected_videos), start=1))
+        to_run = self.resolve_downloads(matrix, format_id, videos, indexes)
+
+        manifest.start(to_run)
+        self.run_downloads(to_run, playlist_dir, manifest, archive)
+
+    def sync(self, url, format_id=None):
+        """
+        Bring an already mirrored playlist up to date without any prompts: one flat listing is diffed
+        against the playlist's archive, and only new or changed videos are extracted and downloaded.
+        Files of videos that moved are renamed to their new position.
+
+        :param format_id: format of new videos, by default the one most archived videos are in
+        """
+        info = extract_info(url, {'quiet': True, 'extract_flat': True})
+        if info.get('entries') is None:
+            print(f"{url} is not a playlist.")
+            return
+        playlist_dir = os.path.join(self.down_dir, sanitize_filename(info.get('title', 'Playlist')))
+        os.makedirs(playlist_dir, exist_ok=True)
+
+        archive = Archive(playlist_dir)
+        plan = archive.diff(list(info['entries']), format_id)
+        print(f"{info.get('title', url)}: {plan.describe()}")
+
+        moves = []
+        for position, entry, row in plan.moved:
+            title = entry.get('title') or row['title']
+            filepath = os.path.join(playlist_dir, f"{position:02d}_{sanitize_filename(title)}"
+                                    + os.path.splitext(row['filepath'])[1])
+            moves.append((video_key(entry), position, title, filepath))
+        archive.move(moves)
+
+        downloads = plan.downloads()
+        if not downloads:
+            archive.close()
+            return
+
+        # Only the videos to download are extracted in full, numbered by their playlist position
+        videos = {position: (position, entry) for position, entry in downloads}
+        indexes = {position: FormatIndex.from_info(video) for position, video in hydrate_videos(downloads)}
+        matrix = CoverageMatrix(indexes)
+        format_id = format_id or archive.preferred_format() or matrix.suggest(OFFERED_HEIGHTS)
+        if not format_id:
+            print("No suitable formats found.")
+            archive.close()
+            return
+        to_run = self.resolve_downloads(matrix, format_id, videos, indexes)
+
+        manifest = Manifest(playlist_dir, canonical_id(url))
+        manifest.start(to_run)
+        self.run_downloads(to_run, playlist_dir, manifest, archive)
+
+    @staticmethod
+    def resolve_downloads(matrix, format_id, videos, indexes):
+        """
+        :param videos: number -> (playlist position, flat entry)
+        :return: the videos to download, each in format_id or its closest available format
+        """
+        to_run = []
+        for idx, chosen in matrix.resolve(format_id).items():
+            position, video = videos[idx]
+            video_url, video_title = video['url'], video['title']
+            if chosen is None:
+                print(f"Skipped {video_title}: no video formats available.")
+                continue
+            if chosen != format_id:
+                print(f"{video_title}: format {format_id} is not available, using {chosen} instead.")
+            to_run.append({'number': idx, 'url': video_url, 'title': video_title, 'format_id': chosen,
+                           'id': video_key(video), 'position': position, 'host': indexes[idx].get(chosen).host})
+        return to_run
+
+    def run_downloads(self, videos, playlist_dir, manifest, archive=None):
+        scheduler = DownloadScheduler()
+        submitted = {}
+        for video in videos:
+            print(f"Downloading {video['title']} in format {video['format_id']}...")
+            host = video.get('host') or urlparse(video['url']).netloc
+            submitted[video['number']] = video, scheduler.submit(
+                video['number'], host, download_video, video['url'], video['format_id'],
+                playlist_dir, video['number'], video['title'], manifest)
+
+        results = scheduler.wait()
+        self.report_failures(results)
+        scheduler.shutdown()
+        if archive is not None:
+            # Only finished videos are archived, a failed one is downloaded again by the next sync
+            for idx, error in results:
+                if error is None:
+                    video, future = submitted[idx]
+                    downloads = future.result().result().get('requested_downloads') or [{}]
+                    archive.record(video_key(video), video.get('position') or idx, video['title'],
+                                   video['format_id'], downloads[0].get('filepath'))
+            archive.close()
+        print(metrics.summary())
+
+    @staticmethod
+    def report_failures(results):
+        for idx, error in results:
+            if error is not None:
+                print(f"Download {idx} failed: {error}")
 
 
 if __name__ == "__main__":
-    link = "https://youtube.com/playlist?list=PLBlnK6fEyqRjSgal6OIEfzK4upXvkHSxW&feature=shared"
-    obj = Download()
-    obj.main(link)
+    if sys.argv[1:2] == ['sync']:
+        # python ytdl.py sync [--home DIR] PLAYLIST_URL [PLAYLIST_URL ...], e.g. from a nightly cron job
+        parser = argparse.ArgumentParser(prog='ytdl.py sync', description="Update mirrored playlists.")
+        parser.add_argument('urls', nargs='+', metavar='PLAYLIST_URL')
+        parser.add_argument('--home', help="directory holding yt_dlp_Downloads (default: $YTDL_HOME or the current directory)")
+        parser.add_argument('--format', help="format ID to mirror in (default: the one most archived videos are in)")
+        args = parser.parse_args(sys.argv[2:])
+        obj = Download(home=args.home)
+        for link in args.urls:
+            obj.sync(link, args.format)
+    else:
+        link = "https://youtube.com/playlist?list=PLBlnK6fEyqRjSgal6OIEfzK4upXvkHSxW&feature=shared"
+        obj = Download()
+        obj.main(link)
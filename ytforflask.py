@@ -7,10 +7,16 @@ User Stories
 
 """
 
-import yt_dlp
 import os
 import sys
 import re
+from urllib.parse import urlparse
+
+from cache import extract_info
+from selection import Selection
+from formats import FormatIndex
+from download import download_info
+from retry import call_with_retries
 
 
 class Data:
@@ -61,8 +67,7 @@ class Get:
         options = {
             'quiet': True
         }
-        with yt_dlp.YoutubeDL(options) as ydl:
-            info = ydl.extract_info(self.url, download=False)
+        info = extract_info(self.url, options)
 
         data = Data()
         data.set_url(self.url)
@@ -98,18 +103,10 @@ class GetLink:
     def get_formats(info) -> list:
 
         print("\nAvailable formats:")
-        filtered_formats = []
-        for i in range(len(info["formats"])):
-            if 'ext' in info["formats"][i].keys() and info["formats"][i].get('ext') == 'mp4':
-                if info["formats"][i].get('height') in [1080, 720, 480]:
-                    filtered_formats.append(info["formats"][i])
+        filtered_formats = FormatIndex.from_info(info).select([1080, 720, 480], ext='mp4')
 
         for fmt in filtered_formats:
-            format_id = fmt.get('format_id')
-            resolution = fmt.get('resolution')
-            file_size = fmt.get('filesize')  # in bytes
-            size_in_mb = f"{file_size / (1024 * 1024):.2f} MB" if file_size else "Unknown size"
-            print(f"{format_id}: {resolution}, {size_in_mb}")
+            print(fmt.describe())
 
         return filtered_formats
 
@@ -121,8 +118,7 @@ class GetLink:
         options = {
             'quiet': True
         }
-        with yt_dlp.YoutubeDL(options) as ydl:
-            self.info = ydl.extract_info(self.url, download=False)
+        self.info = extract_info(self.url, options)
 
         return self.info
 
@@ -131,8 +127,7 @@ class GetLink:
         ydl_opts = {
             'quiet': True,
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        info = extract_info(url, ydl_opts)
 
         return format_id in [fmt['format_id'] for fmt in info['formats']]
 
@@ -158,33 +153,27 @@ class VideoDownloader:
             'merge_output_format': 'mp4',
             'outtmpl': f"{sanitized_title}.%(ext)s"
         }
+        host = urlparse(info.get('url') or info.get('webpage_url') or '').netloc
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([info["webpage_url"]])
+            # Throttling and dropped connections are retried with backoff, anything else is reported
+            return call_with_retries(download_info, info, ydl_opts, host=host)
         except Exception as e:
             print(f"Something went wrong. Try looking for ...\n, {e}")
-            exit(0)
+            return None
 
 
 class PlaylistDownloader:
     def __init__(self):
         self.retry = 0
         self.videos_to_download = []
-        self.video_entries = []
+        self.video_entries = {}  # playlist position -> flat entry
         self.playlist_title = ''
 
     def get_videos_to_download(self):
 
         try:
             videos = input("Enter index of video download. \nEnter comma separated values and range. \nEg: 1,2,3-7,12\n")
-            for i in videos.split(','):
-                if '-' in i:
-                    start, end = map(int, i.split('-'))
-                    self.videos_to_download.extend(range(start, end+1))
-                elif not i:
-                    continue
-                else:
-                    self.videos_to_download.append(int(i.strip()))
+            self.videos_to_download.extend(Selection.parse(videos).indices())
         except Exception as e:
             print(f"Exception in retrieving videos.\n{e}")
         finally:
@@ -197,35 +186,52 @@ class PlaylistDownloader:
             else:
                 return
 
-    def list_playlist_videos(self, url):
+    def list_playlist_videos(self, url, selection=None):
         ydl_opts = {
             'quiet': True,
             'extract_flat': True  # Only list videos without downloading
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        if selection:
+            # Only the selected entries are fetched
+            ydl_opts = selection.options(ydl_opts)
+        info = extract_info(url, ydl_opts)
 
+        self.video_entries = {}
         if 'entries' in info:
             print("\nPlaylist contents:")
-            for idx, entry in enumerate(info['entries'], start=1):
-                print(f"{idx}. {entry['title']}")
+            # Positions in the playlist, also when only the selected entries were listed
+            indices = info.get('requested_entries') or range(1, len(info['entries']) + 1)
+            for idx, entry in zip(indices, info['entries']):
+                if entry:
+                    self.video_entries[idx] = entry
+                    print(f"{idx}. {entry['title']}")
         else:
             print("The provided URL is not a playlist.")
 
-        self.video_entries, self.playlist_title = info.get('entries', []), GetLink.sanitize_filename(info.get('title', 'Playlist'))
+        self.playlist_title = GetLink.sanitize_filename(info.get('title', 'Playlist'))
 
 
-    def download(self, url):
-        self.list_playlist_videos(url)
-        self.get_videos_to_download()
+    def download(self, url, selection=None):
+        """
+        :param selection: Selection of playlist positions, only those entries are listed. Without one the
+            whole playlist is listed and the user picks from it.
+        """
+        self.list_playlist_videos(url, selection)
+        if selection:
+            self.videos_to_download = list(selection.indices())
+        else:
+            self.get_videos_to_download()
 
         if not os.path.exists(self.playlist_title):
             os.mkdir(self.playlist_title)
 
-        selected_videos = [self.video_entries[int(i) - 1]['url'] for i in self.videos_to_download]
+        selected_videos = [self.video_entries[i]['url'] for i in self.videos_to_download if i in self.video_entries]
+        if not selected_videos:
+            print("None of the selected videos are in the playlist.")
+            return
 
         print("\nSelect a resolution for all videos:")
-        formats = GetLink.get_formats(info)
+        formats = GetLink.get_formats(extract_info(selected_videos[0], {'quiet': True}))
         if formats:
             format_id = input("Enter the format ID you wish to download: ")
         else: